@@ -13,13 +13,28 @@ import base64
 import shutil
 from io import BytesIO
 from pathlib import Path
-import traceback
 import re
+import html
+import logging
 import copy
+import time
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+import functools
+import weakref
+import mimetypes
+import itertools
+import bisect
+import statistics
+from collections import OrderedDict, Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
 
-from flask import Flask, request, jsonify, render_template, abort, send_from_directory, Response
+from flask import Flask, request, jsonify, render_template, abort, send_from_directory, send_file, Response
 import ollama
-from PIL import Image
+from PIL import Image, ImageOps
 import fitz  # PyMuPDF
 import pillow_heif
 import docx
@@ -34,7 +49,41 @@ CHATS_DIR = Path('chats')
 ATTACHMENTS_DIR_NAME = 'attachments'
 CHATS_DIR.mkdir(exist_ok=True)
 TITLE_GENERATION_MODEL = 'gemma3:1b'
-CONTEXT_WINDOW_MESSAGES = 20
+DEFAULT_CONTEXT_TOKENS = 8192 # Context window (num_ctx) requested for models not listed below
+MODEL_CONTEXT_TOKENS = {FIXED_VISION_MODEL: 4096, TITLE_GENERATION_MODEL: 2048}
+RESPONSE_TOKEN_RESERVE = 1024 # Part of the context window kept free for the answer
+IMAGE_TOKEN_ESTIMATE = 768 # Approximate prompt cost of one attached image for vision models
+ATTACHMENT_INDEX_FILENAME = 'attachments_index.sqlite3' # Per-chat chunk index, next to attachments/
+RETRIEVAL_CHUNK_CHARS = 1600 # ~400 tokens per chunk
+RETRIEVAL_CHUNK_OVERLAP = 200
+RETRIEVAL_TOP_K = 6
+RETRIEVAL_INLINE_TOKENS = 2000 # Documents up to this size are still inlined whole
+RETRIEVAL_MIN_SCORE = 0.5 # Minimum BM25 relevance of a retrieved chunk (terms in most chunks score ~0)
+RETRIEVAL_STOPWORDS = frozenset("""
+    about above after again all also and any are because been before being below between both but can
+    could did does doing down during each few for from further had has have having her here hers him
+    his how into its itself just more most not now off once only other our ours out over own same she
+    should some such than that the their theirs them then there these they this those through too under
+    until very was were what when where which while who whom why will with would you your yours
+""".split()) # Words too common to say anything about relevance
+EXTRACTION_WORKERS = max(1, (os.cpu_count() or 2) - 1) # Processes used to parse PDF/DOCX uploads
+PDF_PAGES_PER_TASK = 16 # PDF pages parsed per process-pool task
+EXTRACTION_CACHE_DIR = Path('cache') / 'extracted_text' # Extracted text keyed by file SHA-256
+ATTACHMENT_STORE_DIR = Path('attachment_store') # Content-addressed uploads shared across chats
+VISION_IMAGE_MAX_SIDE = 1024 # Longest side of the JPEG variant sent to the vision model
+VISION_IMAGE_JPEG_QUALITY = 85
+VISION_B64_CACHE_SIZE = 64 # Base64-encoded vision variants kept in memory
+CHAT_STORAGE_BACKEND = 'log' # 'log' (append-only history.jsonl) or 'json' (legacy history.json)
+CHAT_LOG_COMPACT_THRESHOLD = 200 # Log records replayed before a chat log is compacted into a snapshot
+CHAT_CACHE_SIZE = 64 # Parsed chats kept in memory for active conversations
+HEAVY_MESSAGE_FIELDS = ('extracted_content',) # Left out of chat pages; fetched per message on demand
+CHAT_INDEX_FILE = CHATS_DIR / 'chat_index.sqlite3'
+CHAT_INDEX_SYNC_INTERVAL = 60 # Seconds between reconciliations of the index with the chat folders
+CHAT_INDEX_SCHEMA_VERSION = 1 # Bumped when the index gains tables; older indexes are rebuilt on startup
+HISTORY_SEARCH_INCLUDE_ATTACHMENTS = True # Also make extracted document text searchable
+HISTORY_SEARCH_DEFAULT_LIMIT = 20
+HISTORY_SEARCH_MAX_LIMIT = 100
+HISTORY_SEARCH_TITLE_WEIGHT = 10.0 # bm25 weight of title matches relative to message text
 
 # System prompt to instruct the AI on how to use the web search tool.
 WEB_SEARCH_SYSTEM_PROMPT = """You are a large language model with access to a real-time web search tool.
@@ -45,11 +94,202 @@ To use the search tool, you must respond with a special search command in the fo
 {"query": "your concise search query here"}
 </search>
 
+If you need several independent facts, you may request up to three searches at once:
+<search>
+{"queries": ["first concise query", "second concise query"]}
+</search>
+
 You will receive the search results back. After you receive the results, you MUST answer the user's original question based on the information from the search results. Do not make up information.
 """
+OLLAMA_MAX_CONCURRENT = 2 # Requests sent to Ollama at the same time, across all models
+DEFAULT_MODEL_CONCURRENCY = 1 # Concurrent requests per model unless listed in MODEL_CONCURRENCY
+MODEL_CONCURRENCY = {}
+SCHEDULER_MAX_BATCH_WAIT = 10 # Seconds a request may be held back to batch requests for a loaded model
+SCHEDULER_STATUS_INTERVAL = 1.0 # Seconds between queue-position updates on the stream
+TITLE_QUEUE_TIMEOUT = 30 # Seconds title generation waits for a slot before falling back to the prompt
+MODEL_CATALOG_TTL = 60 # Seconds the model list and capabilities read from Ollama are reused
+MODEL_STATUS_TTL = 5 # Seconds the list of models currently loaded in Ollama is reused
+PINNED_MODELS = (FIXED_VISION_MODEL, TITLE_GENERATION_MODEL) # Pre-warmed and kept loaded
+PINNED_KEEP_ALIVE = '30m' # keep_alive sent with requests for pinned models (-1: never unload)
+MODEL_PREWARM_TOP = 1 # The most used chat models are pinned as well
+MODEL_PREWARM_INTERVAL = 300 # Seconds between pre-warm passes
+MODEL_WARM_QUEUE_TIMEOUT = 30 # Seconds a pre-warm waits for a slot before giving up
+MODEL_COLD_LOAD_SECONDS = 0.5 # Load durations reported by Ollama above this count as cold loads
+MODEL_LOAD_SAMPLES = 20 # Recent load durations kept per model, for cold and warm loads each
+PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND = 0, 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BACKGROUND: 'background'} # Metric labels
+MAX_TOOL_ROUNDS = 3 # Web searches the model may run before it must answer
+JOB_BUFFER_CHARS = 256_000 # Answer text kept per generation job for clients that reattach
+JOB_RETENTION_SECONDS = 300 # How long finished jobs stay available for replay
+STREAM_PROTOCOL_VERSION = 1 # Version of the typed (NDJSON/SSE) stream protocol
+STREAM_BATCH_INTERVAL = 0.05 # Seconds answer tokens are coalesced before a write...
+STREAM_BATCH_CHARS = 1024 # ...unless this much text is already waiting
+SEARCH_BACKEND = 'duckduckgo'
+SEARCH_MAX_RESULTS = 5
+SEARCH_MAX_QUERIES = 3 # Queries accepted from a single <search> block
+SEARCH_TIMEOUT = 10 # Seconds to wait for all queries of a <search> block
+SEARCH_CACHE_TTL = 6 * 3600 # Seconds a cached result set stays valid
+SEARCH_CACHE_SIZE = 256 # Result sets kept in memory
+SEARCH_CACHE_FILE = Path('cache') / 'web_search.sqlite3'
+SEARCH_TAG_OPEN = '<search>'
+SEARCH_TAG_CLOSE = '</search>'
+LOG_FORMAT = 'json' # 'json' (one object per line) or 'text'
+LOG_LEVEL = 'INFO'
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120) # Seconds
+METRICS_RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200) # Tokens per second
 
 app = Flask(__name__)
 
+# --- Logging and Metrics ---
+# Log records are structured: an event name plus key/value fields, written as one JSON object
+# per line (or as readable text with LOG_FORMAT = 'text'). Metrics are kept in process and
+# served in the Prometheus text format on /metrics.
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        event = getattr(record, 'event', record.name)
+        fields = getattr(record, 'fields', {})
+        exception = self.formatException(record.exc_info) if record.exc_info else None
+        if LOG_FORMAT == 'text':
+            line = f"{self.formatTime(record)} {record.levelname} {event}: {record.getMessage()}"
+            if fields: line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+            return f"{line}\n{exception}" if exception else line
+        entry = {"time": self.formatTime(record), "level": record.levelname, "event": event, "message": record.getMessage(), **fields}
+        if exception: entry["exception"] = exception
+        return json.dumps(entry, default=str)
+
+logger = logging.getLogger('chat_app')
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(StructuredFormatter())
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+def log_event(level, event, message, exc_info=False, **fields):
+    """Logs `message` under a stable event name, with `fields` as structured data."""
+    logger.log(level, message, exc_info=exc_info, extra={"event": event, "fields": fields})
+
+METRICS = [] # Every metric, in /metrics order
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name, self.help_text = name, help_text
+        self._values = {} # Label key -> value
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+class MetricCounter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class MetricHistogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=METRICS_LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1 # Last slot is the +Inf bucket
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", key + (('le', '+Inf' if bound == float('inf') else f"{bound:g}"),), cumulative))
+                samples.append((f"{self.name}_sum", key, total[0]))
+                samples.append((f"{self.name}_count", key, cumulative))
+        return samples
+
+class MetricGauge(_Metric):
+    """A gauge read when /metrics is scraped; `collect` returns a list of (labels dict, value)."""
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, collect):
+        super().__init__(name, help_text)
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, _label_key(labels), value) for labels, value in self.collect()]
+
+def _escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(key):
+    if not key: return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in key) + "}"
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{_format_labels(key)} {value}" for name, key, value in metric.samples())
+    return "\n".join(lines) + "\n"
+
+INFERENCE_QUEUE_WAIT = MetricHistogram('chat_inference_queue_wait_seconds', 'Time requests waited for an inference slot.')
+TIME_TO_FIRST_TOKEN = MetricHistogram('chat_time_to_first_token_seconds', 'Time from the start of answer generation to the first answer token.')
+OLLAMA_PROMPT_EVAL = MetricHistogram('ollama_prompt_eval_seconds', 'Prompt evaluation time reported by Ollama.')
+OLLAMA_EVAL = MetricHistogram('ollama_eval_seconds', 'Token generation time reported by Ollama.')
+OLLAMA_LOAD = MetricHistogram('ollama_load_seconds', 'Model load time reported by Ollama.')
+OLLAMA_TOKENS_PER_SECOND = MetricHistogram('ollama_eval_tokens_per_second', 'Generation speed reported by Ollama.', METRICS_RATE_BUCKETS)
+OLLAMA_PROMPT_TOKENS = MetricCounter('ollama_prompt_tokens_total', 'Prompt tokens evaluated by Ollama.')
+OLLAMA_GENERATED_TOKENS = MetricCounter('ollama_generated_tokens_total', 'Tokens generated by Ollama.')
+ATTACHMENT_EXTRACTION = MetricHistogram('chat_attachment_extraction_seconds', 'Time until the text of one attachment was available.')
+WEB_SEARCH_LATENCY = MetricHistogram('chat_web_search_seconds', 'Latency of web search backend queries.')
+WEB_SEARCH_CACHE = MetricCounter('chat_web_search_cache_requests_total', 'Web search cache lookups.')
+HISTORY_IO = MetricHistogram('chat_history_io_seconds', 'Time spent reading and writing chat histories on disk.')
+HISTORY_CACHE = MetricCounter('chat_history_cache_requests_total', 'Lookups of parsed chats in the in-memory cache.')
+GENERATIONS = MetricCounter('chat_generations_total', 'Finished generation jobs.')
+MODEL_LOADS = MetricCounter('ollama_model_loads_total', 'Model loads reported by Ollama, cold or warm (see MODEL_COLD_LOAD_SECONDS).')
+
+def record_ollama_usage(model, usage):
+    """Records Ollama's counters (see add_usage) and returns its durations in seconds."""
+    timings = {
+        "prompt_eval": usage.get('prompt_eval_duration', 0) / 1e9,
+        "eval": usage.get('eval_duration', 0) / 1e9,
+        "load": usage.get('load_duration', 0) / 1e9,
+    }
+    OLLAMA_PROMPT_EVAL.observe(timings["prompt_eval"], model=model)
+    OLLAMA_EVAL.observe(timings["eval"], model=model)
+    OLLAMA_LOAD.observe(timings["load"], model=model)
+    OLLAMA_PROMPT_TOKENS.inc(usage.get('prompt_eval_count', 0), model=model)
+    OLLAMA_GENERATED_TOKENS.inc(usage.get('eval_count', 0), model=model)
+    model_registry.record_load(model, timings["load"])
+    if timings["eval"] > 0:
+        timings["tokens_per_second"] = usage.get('eval_count', 0) / timings["eval"]
+        OLLAMA_TOKENS_PER_SECOND.observe(timings["tokens_per_second"], model=model)
+    return timings
+
 # --- Helper Function to Prepare Messages for Ollama ---
 def prepare_messages_for_llm(messages, include_images=False, chat_id=None):
     """
@@ -75,52 +315,619 @@ def prepare_messages_for_llm(messages, include_images=False, chat_id=None):
             for att in last_msg.get('attachments', []):
                 if att.get('type', '').startswith('image/'):
                     try:
+                        if 'sha256' in att:
+                            images_b64.append(vision_image_b64(att['sha256']))
+                            continue
+                        # Legacy per-chat attachment stored before the content-addressed store
                         filename = Path(att['url']).name
                         attachment_path = CHATS_DIR / chat_id / ATTACHMENTS_DIR_NAME / filename
                         with open(attachment_path, 'rb') as img_file:
                             images_b64.append(base64.b64encode(img_file.read()).decode('utf-8'))
                     except Exception as e:
-                        print(f"Error reading image attachment {att['url']}: {e}")
+                        log_event(logging.ERROR, 'image_read_failed', "Error reading image attachment", url=att['url'], error=str(e))
             if images_b64:
                 last_msg['images'] = images_b64
                 
     return prepared_messages
 
-# --- Chat History Management (Folder-based) ---
-def get_all_chats_from_disk():
-    chat_list = []
+# --- Context Window Management ---
+# Prompts are assembled against a per-model token budget instead of a fixed message count.
+# Token counts are approximate (~4 characters per token) and cached on each message as
+# 'token_count' (and 'extracted_token_count' for attached document text).
+def estimate_tokens(text):
+    return (len(text) + 3) // 4 if text else 0
+
+def context_token_budget(model):
+    """The configured context size of a model, capped at its native context length when Ollama reports one."""
+    configured = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+    native = model_registry.context_length(model)
+    return min(configured, native) if native else configured
+
+def message_token_count(message, include_extracted=False):
+    """Returns the (cached) token estimate of a message, computing and storing it on first use."""
+    if 'token_count' not in message:
+        message['token_count'] = estimate_tokens(message.get('content', '')) + 4 # Role/format overhead
+    if 'extracted_content' in message and 'extracted_token_count' not in message:
+        message['extracted_token_count'] = estimate_tokens(message['extracted_content'])
+    tokens = message['token_count']
+    if include_extracted: tokens += message.get('extracted_token_count', 0)
+    return tokens
+
+def build_context_window(messages, model, extra_tokens=0):
+    """
+    Selects the newest messages that fit into the model's token budget, dropping older turns.
+    Only the last message's document text is sent to the model (see prepare_messages_for_llm),
+    so it is the only one counted with it; if that message alone does not fit, its document
+    text is truncated. Returns a new list; the last message is copied if it had to change.
+    """
+    if not messages: return []
+    budget = context_token_budget(model) - RESPONSE_TOKEN_RESERVE - extra_tokens
+    last_msg = messages[-1]
+    last_cost = message_token_count(last_msg, include_extracted=True)
+    if last_msg.get('role') == 'user':
+        last_cost += IMAGE_TOKEN_ESTIMATE * sum(1 for att in last_msg.get('attachments', []) if att.get('type', '').startswith('image/'))
+
+    if last_cost > budget and 'extracted_content' in last_msg:
+        last_msg = dict(last_msg)
+        overflow = last_cost - budget
+        keep_tokens = max(0, last_msg['extracted_token_count'] - overflow)
+        last_msg['extracted_content'] = last_msg['extracted_content'][:keep_tokens * 4] + "\n\n[... document truncated to fit the context window ...]"
+        last_cost = budget
+
+    selected = [last_msg]
+    used = last_cost
+    for message in reversed(messages[:-1]):
+        cost = message_token_count(message)
+        if used + cost > budget: break
+        selected.append(message)
+        used += cost
+    selected.reverse()
+    if len(selected) < len(messages):
+        log_event(logging.INFO, 'context_trimmed', "Context window trimmed", model=model, kept=len(selected), total=len(messages), tokens=used)
+    return selected
+
+# --- Attachment Retrieval (per-chat BM25 index) ---
+# Extracted document text is split into overlapping chunks and stored in a per-chat SQLite FTS5
+# table next to attachments/. At answer time only the chunks most relevant to the user's prompt
+# (ranked with BM25) are injected, instead of the whole document. The index outlives the turn,
+# so later questions about the same documents reuse it without re-parsing the files. Chunks are
+# keyed by the attachment's stored filename; retrieval only considers attachments still in the
+# chat, and deleting or truncating messages drops the chunks nothing references anymore.
+def _attachment_index_path(chat_id):
+    return CHATS_DIR / chat_id / ATTACHMENT_INDEX_FILENAME
+
+@contextmanager
+def attachment_index(chat_id):
+    conn = sqlite3.connect(_attachment_index_path(chat_id), timeout=10)
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(content, source UNINDEXED, filename UNINDEXED, ordinal UNINDEXED)")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def split_into_chunks(text, size=RETRIEVAL_CHUNK_CHARS, overlap=RETRIEVAL_CHUNK_OVERLAP):
+    """Splits text into chunks of roughly `size` characters, preferring paragraph boundaries."""
+    chunks, current = [], ""
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph: continue
+        if current and len(current) + len(paragraph) + 2 > size:
+            chunks.append(current)
+            current = current[-overlap:] # Carry some context over into the next chunk
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+        while len(current) > size: # A single oversized paragraph: hard-split it
+            chunks.append(current[:size])
+            current = current[size - overlap:]
+    if current.strip(): chunks.append(current)
+    return chunks
+
+def index_attachment_text(chat_id, source, filename, text):
+    """Adds the chunks of one extracted document to the chat's attachment index."""
+    chunks = split_into_chunks(text)
+    if not chunks: return
+    try:
+        with attachment_index(chat_id) as conn:
+            conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+            conn.executemany(
+                "INSERT INTO chunks (content, source, filename, ordinal) VALUES (?, ?, ?, ?)",
+                [(chunk, source, filename, i) for i, chunk in enumerate(chunks)]
+            )
+    except sqlite3.Error as e:
+        log_event(logging.WARNING, 'attachment_index_failed', "Could not index attachment for retrieval", filename=filename, error=str(e))
+
+def attachment_sources(messages):
+    """The index sources (stored filenames) of all attachments in the messages."""
+    return {Path(att['url']).name for msg in messages for att in msg.get('attachments', []) if att.get('url')}
+
+def prune_attachment_index(chat_id, messages):
+    """Drops the chunks of attachments that are no longer in the chat's messages."""
+    if not _attachment_index_path(chat_id).exists(): return
+    sources = sorted(attachment_sources(messages))
+    try:
+        with attachment_index(chat_id) as conn:
+            conn.execute(f"DELETE FROM chunks WHERE source NOT IN ({','.join('?' * len(sources))})", sources)
+    except sqlite3.Error as e:
+        log_event(logging.WARNING, 'attachment_index_failed', "Could not prune the attachment index", chat_id=chat_id, error=str(e))
+
+def retrieve_attachment_chunks(chat_id, query, sources, top_k=RETRIEVAL_TOP_K):
+    """
+    Returns up to top_k (filename, chunk) pairs from the given sources, ranked by BM25 relevance
+    to the query's meaningful terms; chunks scoring below RETRIEVAL_MIN_SCORE are left out.
+    """
+    if not chat_id or not sources or not _attachment_index_path(chat_id).exists(): return []
+    terms = {t for t in re.findall(r'\w+', query.lower()) if len(t) > 2 and t not in RETRIEVAL_STOPWORDS}
+    if not terms: return []
+    match = " OR ".join(f'"{t}"' for t in terms)
+    sources = sorted(sources)
+    try:
+        with attachment_index(chat_id) as conn:
+            rows = conn.execute(
+                f"SELECT filename, content, source, ordinal, bm25(chunks) FROM chunks WHERE chunks MATCH ? AND source IN ({','.join('?' * len(sources))}) "
+                "ORDER BY bm25(chunks) LIMIT ?",
+                (match, *sources, top_k)
+            ).fetchall()
+    except sqlite3.Error as e:
+        log_event(logging.WARNING, 'attachment_retrieval_failed', "Attachment retrieval failed", chat_id=chat_id, error=str(e))
+        return []
+    rows = [row for row in rows if -row[4] >= RETRIEVAL_MIN_SCORE] # FTS5's bm25() is negated: lower is better
+    rows.sort(key=lambda r: (r[2], r[3])) # Present chunks in document order
+    return [(filename, content) for filename, content, _, _, _ in rows]
+
+def attach_retrieved_context(chat_id, messages):
+    """
+    Returns the messages with the last user message's document text replaced by the chunks
+    most relevant to its prompt. Small documents attached to this turn are kept whole, and
+    chats without attachments skip retrieval altogether.
+    """
+    if not messages or messages[-1].get('role') != 'user': return messages
+    last_msg = messages[-1]
+    if 'extracted_content' in last_msg:
+        message_token_count(last_msg)
+        if last_msg['extracted_token_count'] <= RETRIEVAL_INLINE_TOKENS: return messages
+    sources = attachment_sources(messages)
+    if not sources: return messages
+    chunks = retrieve_attachment_chunks(chat_id, last_msg.get('content', '').replace('[Web Search Activated]', ''), sources)
+    if not chunks: return messages
+    log_event(logging.INFO, 'attachment_chunks_retrieved', "Retrieved attachment chunks", chat_id=chat_id, chunks=len(chunks))
+    last_msg = {k: v for k, v in last_msg.items() if k != 'extracted_token_count'}
+    last_msg['extracted_content'] = "\n\n".join(f"--- Excerpt from {filename} ---\n{content}" for filename, content in chunks)
+    return messages[:-1] + [last_msg]
+
+# --- Chat Index (SQLite) ---
+# A small metadata table (id, title, mtime, message count) so listing chats never has to
+# parse every chat history, plus a full-text index over titles, messages and extracted
+# document text for searching all chats. Both are updated incrementally whenever a chat is
+# changed or deleted, and reconciled against the chat folders when missing or stale.
+_chat_index_last_sync = 0.0
+
+@contextmanager
+def chat_index():
+    conn = sqlite3.connect(CHAT_INDEX_FILE, timeout=10)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS chats (id TEXT PRIMARY KEY, title TEXT NOT NULL, mtime REAL NOT NULL, message_count INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS chats_by_mtime ON chats (mtime DESC, id DESC)")
+        # search_docs maps each full-text row to its chat and message position (-1 for the
+        # title); FTS5 cannot index those columns itself, and they are needed to update rows.
+        conn.execute("CREATE TABLE IF NOT EXISTS search_docs (id INTEGER PRIMARY KEY, chat_id TEXT NOT NULL, position INTEGER NOT NULL, kind TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS search_docs_by_chat ON search_docs (chat_id, position)")
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(title, content, tokenize='unicode61 remove_diacritics 2')")
+        if conn.execute("PRAGMA user_version").fetchone()[0] < CHAT_INDEX_SCHEMA_VERSION:
+            # Index from an older version: forget the indexed mtimes so the next sync re-reads every chat
+            with conn:
+                conn.execute("DELETE FROM chats")
+                conn.execute(f"PRAGMA user_version = {CHAT_INDEX_SCHEMA_VERSION}")
+        with conn: # Commits on success, rolls back on error
+            yield conn
+    finally:
+        conn.close()
+
+def _index_upsert(conn, chat_id, chat_data, mtime):
+    conn.execute(
+        "INSERT OR REPLACE INTO chats (id, title, mtime, message_count) VALUES (?, ?, ?, ?)",
+        (chat_id, chat_data.get("title", "Untitled Chat"), mtime, len(chat_data.get("messages", [])))
+    )
+
+def _search_remove(conn, chat_id, start=None, end=None):
+    """Removes a chat's full-text rows, optionally only those for positions in [start, end)."""
+    query, params = "SELECT id FROM search_docs WHERE chat_id = ?", [chat_id]
+    if start is not None:
+        query += " AND position >= ?"
+        params.append(start)
+    if end is not None:
+        query += " AND position < ?"
+        params.append(end)
+    doc_ids = conn.execute(query, params).fetchall()
+    conn.executemany("DELETE FROM search_fts WHERE rowid = ?", doc_ids)
+    conn.executemany("DELETE FROM search_docs WHERE id = ?", doc_ids)
+
+def _search_insert(conn, chat_id, position, kind, title='', content=''):
+    doc_id = conn.execute("INSERT INTO search_docs (chat_id, position, kind) VALUES (?, ?, ?)", (chat_id, position, kind)).lastrowid
+    conn.execute("INSERT INTO search_fts (rowid, title, content) VALUES (?, ?, ?)", (doc_id, title, content))
+
+def _search_index_title(conn, chat_id, chat_data):
+    _search_remove(conn, chat_id, -1, 0)
+    _search_insert(conn, chat_id, -1, 'title', title=chat_data.get("title", "Untitled Chat"))
+
+def _search_index_messages(conn, chat_id, messages, start, end=None):
+    """(Re)indexes messages[start:end], replacing any rows held for those positions."""
+    _search_remove(conn, chat_id, start, end)
+    for position, message in enumerate(messages[start:end], start):
+        if message.get('content'):
+            _search_insert(conn, chat_id, position, message.get('role', 'message'), content=message['content'])
+        if HISTORY_SEARCH_INCLUDE_ATTACHMENTS and message.get('extracted_content'):
+            _search_insert(conn, chat_id, position, 'attachment', content=message['extracted_content'])
+
+def _search_apply_op(conn, chat_id, chat_data, op):
+    """Brings the full-text index up to date after `op` was applied; None reindexes the whole chat."""
+    kind = op['op'] if op else 'snapshot'
+    messages = chat_data.get('messages', [])
+    if kind == 'snapshot':
+        _search_remove(conn, chat_id)
+        _search_index_title(conn, chat_id, chat_data)
+        _search_index_messages(conn, chat_id, messages, 0)
+    elif kind == 'title':
+        _search_index_title(conn, chat_id, chat_data)
+    elif kind == 'append':
+        _search_index_messages(conn, chat_id, messages, len(messages) - 1)
+    elif kind == 'truncate':
+        _search_remove(conn, chat_id, op['length'])
+    elif kind == 'delete':
+        _search_index_messages(conn, chat_id, messages, op['index']) # Later messages moved up
+    elif kind == 'edit' or (kind == 'update' and {'content', 'extracted_content'} & op['fields'].keys()):
+        _search_index_messages(conn, chat_id, messages, op['index'], op['index'] + 1)
+
+def index_chat(chat_id, chat_data, mtime, op=None):
+    """Updates the chat's metadata and, for the given operation (default: all of it), its search rows."""
+    try:
+        with chat_index() as conn:
+            if op and not conn.execute("SELECT 1 FROM chats WHERE id = ?", (chat_id,)).fetchone():
+                op = None # Not indexed yet (e.g. right after an index upgrade): index all of it
+            _index_upsert(conn, chat_id, chat_data, mtime)
+            _search_apply_op(conn, chat_id, chat_data, op)
+    except sqlite3.Error as e:
+        log_event(logging.WARNING, 'chat_index_update_failed', "Could not update chat index", chat_id=chat_id, error=str(e))
+
+def unindex_chat(chat_id):
+    try:
+        with chat_index() as conn:
+            conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            _search_remove(conn, chat_id)
+    except sqlite3.Error as e:
+        log_event(logging.WARNING, 'chat_index_remove_failed', "Could not remove chat from chat index", chat_id=chat_id, error=str(e))
+
+def sync_chat_index(force=False):
+    """
+    Reconciles the index with the chat folders. Only chats whose stored mtime differs
+    from the indexed one are re-parsed, so a fresh index is rebuilt once and then kept cheap.
+    """
+    global _chat_index_last_sync
+    if not force and CHAT_INDEX_FILE.exists() and time.time() - _chat_index_last_sync < CHAT_INDEX_SYNC_INTERVAL: return
+    with chat_index() as conn:
+        indexed = dict(conn.execute("SELECT id, mtime FROM chats"))
+    # Chats are read outside the index transaction: writers take the chat lock before the
+    # index, so holding the index while waiting for a chat lock could deadlock.
+    on_disk, changed = set(), []
     for chat_folder in CHATS_DIR.iterdir():
-        if chat_folder.is_dir():
-            history_file = chat_folder / 'history.json'
-            if history_file.exists():
-                try:
-                    with open(history_file, 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                    mtime = history_file.stat().st_mtime
-                    chat_list.append({
-                        "id": chat_folder.name,
-                        "title": data.get("title", "Untitled Chat"),
-                        "mtime": mtime
-                    })
-                except (json.JSONDecodeError, IOError) as e:
-                    print(f"Warning: Could not read or parse {history_file}: {e}")
-    return sorted(chat_list, key=lambda x: x['mtime'], reverse=True)
+        if not chat_folder.is_dir(): continue
+        mtime = CHAT_STORE.mtime(chat_folder.name)
+        if mtime is None: continue
+        on_disk.add(chat_folder.name)
+        if indexed.get(chat_folder.name) == mtime: continue
+        data = load_chat_history(chat_folder.name)
+        if data is None:
+            log_event(logging.WARNING, 'chat_history_unreadable', "Could not read or parse chat history", chat_id=chat_folder.name)
+            continue
+        changed.append((chat_folder.name, data, mtime))
+    with chat_index() as conn:
+        for chat_id, data, mtime in changed:
+            _index_upsert(conn, chat_id, data, mtime)
+            _search_apply_op(conn, chat_id, data, None)
+        for chat_id in set(indexed) - on_disk:
+            conn.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+            _search_remove(conn, chat_id)
+    _chat_index_last_sync = time.time()
 
-def load_chat_history(chat_id):
-    history_file = CHATS_DIR / chat_id / 'history.json'
-    if not history_file.exists(): return None
+def list_chats(limit=None, cursor=None):
+    """
+    Returns (chats, next_cursor) sorted by mtime, newest first. The cursor is an opaque
+    'mtime:id' string taken from the last chat of the previous page (keyset pagination).
+    Raises ValueError for a malformed cursor.
+    """
+    sync_chat_index()
+    query, params = "SELECT id, title, mtime, message_count FROM chats", []
+    if cursor:
+        cursor_mtime, cursor_id = cursor.split(':', 1)
+        query += " WHERE mtime < ? OR (mtime = ? AND id < ?)"
+        params += [float(cursor_mtime), float(cursor_mtime), cursor_id]
+    query += " ORDER BY mtime DESC, id DESC"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    with chat_index() as conn:
+        rows = conn.execute(query, params).fetchall()
+    chats = [{"id": r[0], "title": r[1], "mtime": r[2], "message_count": r[3]} for r in rows]
+    next_cursor = f"{chats[-1]['mtime']!r}:{chats[-1]['id']}" if limit and len(chats) == limit else None
+    return chats, next_cursor
+
+def _fts_query(text):
+    """Turns free text into an FTS5 query: all words must match, the last one as a prefix."""
+    terms = [f'"{term}"' for term in re.findall(r'\w+', text)]
+    if not terms: return None
+    terms[-1] += '*' # Search-as-you-type
+    return ' '.join(terms)
+
+def search_chats(query, limit=HISTORY_SEARCH_DEFAULT_LIMIT):
+    """
+    Full-text search over all chats, best matches first. Each hit names the chat, what matched
+    ('title', 'user', 'assistant' or 'attachment'), the message index (None for titles) and an
+    HTML-escaped snippet with the matched words wrapped in <mark>.
+    """
+    fts_query = _fts_query(query)
+    if not fts_query: return []
+    sync_chat_index()
+    with chat_index() as conn:
+        rows = conn.execute(
+            "SELECT d.chat_id, c.title, d.kind, d.position, snippet(search_fts, -1, char(2), char(3), '…', 16), "
+            "bm25(search_fts, ?, 1.0) AS score "
+            "FROM search_fts JOIN search_docs d ON d.id = search_fts.rowid JOIN chats c ON c.id = d.chat_id "
+            "WHERE search_fts MATCH ? ORDER BY score LIMIT ?",
+            (HISTORY_SEARCH_TITLE_WEIGHT, fts_query, limit)
+        ).fetchall()
+    return [{
+        "chatId": chat_id, "title": title, "kind": kind, "messageIndex": position if position >= 0 else None,
+        "snippet": html.escape(snippet).replace('\x02', '<mark>').replace('\x03', '</mark>'), "score": -score,
+    } for chat_id, title, kind, position, snippet, score in rows]
+
+# --- Chat History Management (Folder-based, pluggable storage) ---
+# Every change to a chat is expressed as a small operation record:
+#   {"op": "append", "message": {...}}     {"op": "truncate", "length": n}
+#   {"op": "delete", "index": i, "count": n}   {"op": "edit", "index": i, "content": "..."}
+#   {"op": "update", "index": i, "fields": {...}}
+#   {"op": "title", "title": "..."}        {"op": "snapshot", "data": {...}}
+# The same records are applied to the in-memory chat dict and handed to the storage
+# backend, which either rewrites history.json (legacy) or appends them to a per-chat log.
+def apply_chat_op(chat_data, op):
+    """Applies a single operation record to a chat dict in place."""
+    kind = op['op']
+    if kind == 'snapshot':
+        chat_data.clear()
+        chat_data.update(copy.deepcopy(op['data']))
+    elif kind == 'append':
+        chat_data['messages'].append(op['message'])
+    elif kind == 'truncate':
+        del chat_data['messages'][op['length']:]
+    elif kind == 'delete':
+        del chat_data['messages'][op['index']:op['index'] + op.get('count', 1)]
+    elif kind == 'edit':
+        message = chat_data['messages'][op['index']]
+        message['content'] = op['content']
+        message.pop('token_count', None) # Stale; recomputed on next use
+        if 'token_count' in op: message['token_count'] = op['token_count']
+    elif kind == 'update':
+        chat_data['messages'][op['index']].update(op['fields'])
+    elif kind == 'title':
+        chat_data['title'] = op['title']
+    else:
+        raise ValueError(f"Unknown chat operation: {kind}")
+
+def _atomic_write_bytes(path, data):
+    """Writes a file via a temporary sibling and os.replace, so readers never see a partial file."""
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
     try:
-        with open(history_file, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, IOError):
-        return None
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+def _atomic_write_text(path, text):
+    _atomic_write_bytes(path, text.encode('utf-8'))
+
+class JsonChatStore:
+    """Legacy layout: the whole conversation is rewritten to history.json on every change."""
+    FILENAME = 'history.json'
+
+    def _path(self, chat_id):
+        return CHATS_DIR / chat_id / self.FILENAME
+
+    def mtime(self, chat_id):
+        path = self._path(chat_id)
+        return path.stat().st_mtime if path.exists() else None
+
+    def load(self, chat_id):
+        path = self._path(chat_id)
+        if not path.exists(): return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError):
+            return None
+
+    def save(self, chat_id, chat_data):
+        (CHATS_DIR / chat_id).mkdir(exist_ok=True)
+        _atomic_write_text(self._path(chat_id), json.dumps(chat_data, indent=4))
+
+    def record(self, chat_id, chat_data, op):
+        self.save(chat_id, chat_data)
+
+class LogChatStore:
+    """
+    Append-only layout: each change is one JSON line in history.jsonl, so the cost of a write
+    no longer depends on the length of the chat. Loading replays the log; once it holds more
+    than CHAT_LOG_COMPACT_THRESHOLD records it is compacted into a single snapshot record, on
+    load or on the write that crosses the threshold (cached chats are rarely re-loaded).
+    Chats that still only have a legacy history.json are read transparently.
+    """
+    FILENAME = 'history.jsonl'
+
+    def __init__(self):
+        self._record_counts = {} # chat_id -> records in its log, for chats loaded or written since startup
+
+    def _path(self, chat_id):
+        return CHATS_DIR / chat_id / self.FILENAME
+
+    def mtime(self, chat_id):
+        path = self._path(chat_id)
+        if path.exists(): return path.stat().st_mtime
+        return JsonChatStore().mtime(chat_id)
+
+    def load(self, chat_id):
+        path = self._path(chat_id)
+        if not path.exists(): return JsonChatStore().load(chat_id)
+        chat_data = {"title": "New Chat", "messages": []}
+        record_count = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip(): continue
+                    try:
+                        apply_chat_op(chat_data, json.loads(line))
+                        record_count += 1
+                    except (json.JSONDecodeError, KeyError, IndexError, ValueError) as e:
+                        # Most likely a torn final line from a crash mid-append; skip it.
+                        log_event(logging.WARNING, 'chat_log_bad_record', "Skipping bad chat log record", path=str(path), line=line_number, error=str(e))
+        except IOError:
+            return None
+        if record_count > CHAT_LOG_COMPACT_THRESHOLD:
+            self.save(chat_id, chat_data)
+        else:
+            self._record_counts[chat_id] = record_count
+        return chat_data
+
+    def save(self, chat_id, chat_data):
+        """Replaces the log with a single snapshot record (also used for compaction)."""
+        (CHATS_DIR / chat_id).mkdir(exist_ok=True)
+        _atomic_write_text(self._path(chat_id), json.dumps({"op": "snapshot", "data": chat_data}) + '\n')
+        self._record_counts[chat_id] = 1
+
+    def record(self, chat_id, chat_data, op):
+        """Appends one op (already applied to chat_data); call under chat_lock(chat_id)."""
+        path = self._path(chat_id)
+        if not path.exists():
+            # First write for this chat (or a legacy chat): start the log from a full snapshot.
+            self.save(chat_id, chat_data)
+            return
+        if chat_id not in self._record_counts:
+            with open(path, 'rb') as f: self._record_counts[chat_id] = sum(1 for line in f if line.strip())
+        if self._record_counts[chat_id] >= CHAT_LOG_COMPACT_THRESHOLD:
+            self.save(chat_id, chat_data) # The snapshot already includes this op
+            return
+        line = json.dumps(op) + '\n'
+        with open(path, 'ab+') as f:
+            # Terminate a torn final line first, so it cannot swallow the new record.
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n': line = '\n' + line
+            f.write(line.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        self._record_counts[chat_id] += 1
+
+CHAT_STORES = {'json': JsonChatStore, 'log': LogChatStore}
+CHAT_STORE = CHAT_STORES[CHAT_STORAGE_BACKEND]()
+
+# Every read-modify-write of a chat runs under that chat's lock, so concurrent requests
+# (stream, regenerate, delete, title) are serialized instead of overwriting each other.
+# Recently used chats stay parsed in an LRU cache; an entry is only trusted while the
+# stored file's mtime is unchanged, so edits made outside the app are still picked up.
+# The cached dict is shared: read it freely, but change it only via update_chat_history
+# while holding chat_lock(chat_id).
+_chat_locks = weakref.WeakValueDictionary() # A lock lives only while someone holds or waits for it
+_chat_locks_guard = threading.Lock()
+_chat_cache = OrderedDict() # chat_id -> (mtime, chat_data), least recently used first
+_chat_cache_lock = threading.Lock()
+
+def chat_lock(chat_id):
+    """Returns the re-entrant lock serializing reads-modify-writes of one chat."""
+    with _chat_locks_guard:
+        lock = _chat_locks.get(chat_id)
+        if lock is None:
+            lock = _chat_locks[chat_id] = threading.RLock()
+        return lock
+
+def _cache_chat(chat_id, mtime, chat_data):
+    with _chat_cache_lock:
+        _chat_cache[chat_id] = (mtime, chat_data)
+        _chat_cache.move_to_end(chat_id)
+        while len(_chat_cache) > CHAT_CACHE_SIZE: _chat_cache.popitem(last=False)
+
+def forget_chat(chat_id):
+    """Drops a chat from the cache, e.g. after it was deleted."""
+    with _chat_cache_lock:
+        _chat_cache.pop(chat_id, None)
+
+def load_chat_history(chat_id):
+    with chat_lock(chat_id):
+        mtime = CHAT_STORE.mtime(chat_id)
+        with _chat_cache_lock:
+            cached = _chat_cache.get(chat_id)
+            if cached and mtime is not None and cached[0] == mtime:
+                _chat_cache.move_to_end(chat_id)
+                HISTORY_CACHE.inc(result='hit')
+                return cached[1]
+        HISTORY_CACHE.inc(result='miss')
+        with HISTORY_IO.time(operation='load'):
+            chat_data = CHAT_STORE.load(chat_id)
+        if chat_data is None:
+            forget_chat(chat_id)
+            return None
+        _cache_chat(chat_id, CHAT_STORE.mtime(chat_id), chat_data) # Loading may have compacted the log
+        return chat_data
 
 def save_chat_history(chat_id, chat_data):
-    chat_folder = CHATS_DIR / chat_id
-    chat_folder.mkdir(exist_ok=True)
-    history_file = chat_folder / 'history.json'
-    with open(history_file, 'w', encoding='utf-8') as f:
-        json.dump(chat_data, f, indent=4)
+    """Writes the full chat. Prefer update_chat_history for incremental changes."""
+    with chat_lock(chat_id):
+        with HISTORY_IO.time(operation='save'):
+            CHAT_STORE.save(chat_id, chat_data)
+        mtime = CHAT_STORE.mtime(chat_id)
+        _cache_chat(chat_id, mtime, chat_data)
+        index_chat(chat_id, chat_data, mtime)
+
+def update_chat_history(chat_id, chat_data, op):
+    """Applies an operation to the in-memory chat and records it in the storage backend."""
+    with chat_lock(chat_id):
+        apply_chat_op(chat_data, op)
+        with HISTORY_IO.time(operation='record'):
+            CHAT_STORE.record(chat_id, chat_data, op)
+        mtime = CHAT_STORE.mtime(chat_id)
+        with _chat_cache_lock:
+            cached = _chat_cache.get(chat_id)
+        if cached and cached[1] is chat_data:
+            _cache_chat(chat_id, mtime, chat_data)
+        else:
+            forget_chat(chat_id) # The op was applied to some other copy of the chat; re-read it next time
+        index_chat(chat_id, chat_data, mtime, op)
+        if op['op'] in ('delete', 'truncate'): prune_attachment_index(chat_id, chat_data['messages'])
+
+def migrate_chat_storage(delete_legacy=False):
+    """
+    Converts every chat folder that only has a legacy history.json into the append-only
+    log format. The old file is kept as history.json.bak unless delete_legacy is set.
+    Returns the number of migrated chats.
+    """
+    migrated = 0
+    log_store, json_store = LogChatStore(), JsonChatStore()
+    for chat_folder in CHATS_DIR.iterdir():
+        legacy_file = chat_folder / JsonChatStore.FILENAME
+        if not chat_folder.is_dir() or not legacy_file.exists(): continue
+        if (chat_folder / LogChatStore.FILENAME).exists():
+            log_event(logging.INFO, 'migration_skipped', "Chat already has a log", chat_id=chat_folder.name)
+            continue
+        chat_data = json_store.load(chat_folder.name)
+        if chat_data is None:
+            log_event(logging.WARNING, 'migration_unreadable', "Could not read or parse legacy history, leaving it untouched", path=str(legacy_file))
+            continue
+        log_store.save(chat_folder.name, chat_data)
+        if delete_legacy:
+            legacy_file.unlink()
+        else:
+            os.replace(legacy_file, legacy_file.with_name(JsonChatStore.FILENAME + '.bak'))
+        migrated += 1
+    return migrated
 
 # --- Core Business Logic ---
 def generate_chat_title(prompt_text):
@@ -132,163 +939,1328 @@ def generate_chat_title(prompt_text):
     if len(prompt_text) < 40: return prompt_text.strip()
     try:
         system_prompt = "Summarize the following user's query into a short, 3-to-5-word title for a chat history list. Do not use quotation marks. Be concise."
-        response = ollama.chat(
-            model=TITLE_GENERATION_MODEL,
-            messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt_text}],
-            options={"num_predict": 20}
-        )
+        with inference_scheduler.slot(TITLE_GENERATION_MODEL, PRIORITY_BACKGROUND, timeout=TITLE_QUEUE_TIMEOUT):
+            response = ollama.chat(
+                model=TITLE_GENERATION_MODEL,
+                messages=[{'role': 'system', 'content': system_prompt}, {'role': 'user', 'content': prompt_text}],
+                options={"num_predict": 20, "num_ctx": context_token_budget(TITLE_GENERATION_MODEL)},
+                keep_alive=model_registry.keep_alive(TITLE_GENERATION_MODEL)
+            )
+        usage = {}
+        add_usage(usage, response)
+        record_ollama_usage(TITLE_GENERATION_MODEL, usage)
         title = response['message']['content'].strip()
         # Clean up potential quotes around the title
         return re.sub(r'^["\']|["\']$', '', title) if title else "Untitled Chat"
     except Exception as e:
-        print(f"Warning: Could not generate title with LLM ({e}). Using prompt as fallback.")
+        log_event(logging.WARNING, 'title_generation_failed', "Could not generate title with LLM, using prompt as fallback", error=str(e))
         return prompt_text[:50].strip() + "..."
 
-def process_and_save_files(chat_id, files):
-    """Processes uploaded files, extracts text content, and saves them."""
-    attachments_data = []
-    extracted_text = ""
-    if not files: return attachments_data, extracted_text
-
-    chat_attachments_dir = CHATS_DIR / chat_id / ATTACHMENTS_DIR_NAME
-    chat_attachments_dir.mkdir(parents=True, exist_ok=True)
+def save_uploaded_files(chat_id, files):
+    """
+    Stores uploaded files in the content-addressed attachment store and references them from
+    the chat. Returns the attachment metadata for the message and the list of saved files
+    (path, name, type, SHA-256) for text extraction.
+    """
+    attachments_data, saved_files = [], []
+    if not files: return attachments_data, saved_files
 
     for file in files:
         original_filename = file.filename
-        unique_filename = f"{uuid.uuid4()}{Path(original_filename).suffix}"
-        save_path = chat_attachments_dir / unique_filename
-        
         file_content = file.read() # Read once
         file.seek(0) # Rewind for any other potential reads
-        
-        with open(save_path, 'wb') as f:
-            f.write(file_content)
+
+        # Reference first, so a concurrent delete of another chat cannot drop the shared blob
+        sha256 = hashlib.sha256(file_content).hexdigest()
+        add_attachment_ref(sha256, chat_id)
+        blob_path = store_blob(sha256, file_content)
+        stored_filename = f"{sha256}{Path(original_filename).suffix.lower()}"
+        if (file.content_type or '').startswith('image/'):
+            schedule_vision_variant(sha256)
 
         attachment_info = {
             "original_filename": original_filename,
-            "url": f"/attachments/{chat_id}/{unique_filename}",
-            "type": file.content_type
+            "url": f"/attachments/{chat_id}/{stored_filename}",
+            "type": file.content_type,
+            "sha256": sha256
         }
         attachments_data.append(attachment_info)
-        
-        # Extract text from supported document types
+        saved_files.append({
+            "path": blob_path,
+            "stored_filename": stored_filename,
+            "original_filename": original_filename,
+            "content_type": file.content_type or '',
+            "sha256": sha256
+        })
+
+    return attachments_data, saved_files
+
+# --- Content-Addressed Attachment Store ---
+# Uploads are stored once under their SHA-256, shared by every chat that references them.
+# A small SQLite table records which chats reference which blob; a blob (with its variants and
+# extracted text) is only deleted once the last referencing chat is gone. Images additionally get a downscaled
+# JPEG variant sized for vision models, whose base64 encoding is cached in memory.
+def _blob_path(sha256):
+    return ATTACHMENT_STORE_DIR / 'blobs' / sha256[:2] / sha256
+
+def _vision_variant_path(sha256):
+    return ATTACHMENT_STORE_DIR / 'variants' / sha256[:2] / f"{sha256}.vision.jpg"
+
+@contextmanager
+def attachment_refs():
+    ATTACHMENT_STORE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(ATTACHMENT_STORE_DIR / 'refs.sqlite3', timeout=10)
+    try:
+        conn.execute("CREATE TABLE IF NOT EXISTS refs (sha256 TEXT NOT NULL, chat_id TEXT NOT NULL, PRIMARY KEY (sha256, chat_id))")
+        conn.execute("CREATE INDEX IF NOT EXISTS refs_by_chat ON refs (chat_id)")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def store_blob(sha256, content):
+    """Stores content under its SHA-256 unless already present. Returns the blob path."""
+    path = _blob_path(sha256)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _atomic_write_bytes(path, content)
+    return path
+
+def add_attachment_ref(sha256, chat_id):
+    with attachment_refs() as conn:
+        conn.execute("INSERT OR IGNORE INTO refs (sha256, chat_id) VALUES (?, ?)", (sha256, chat_id))
+
+def has_attachment_ref(sha256, chat_id):
+    with attachment_refs() as conn:
+        return conn.execute("SELECT 1 FROM refs WHERE sha256 = ? AND chat_id = ?", (sha256, chat_id)).fetchone() is not None
+
+def release_chat_attachments(chat_id):
+    """Drops a chat's references and deletes blobs (and their derived files) no longer referenced by any chat."""
+    with attachment_refs() as conn:
+        shas = [row[0] for row in conn.execute("SELECT sha256 FROM refs WHERE chat_id = ?", (chat_id,))]
+        # The DELETE takes the database's write lock until the transaction ends, so the orphan
+        # check and the unlinks below cannot interleave with add_attachment_ref(): an upload of
+        # the same content either is counted here, or adds its ref (and then re-stores the blob
+        # in store_blob) only after the file is gone.
+        conn.execute("DELETE FROM refs WHERE chat_id = ?", (chat_id,))
+        orphaned = [sha for sha in shas if conn.execute("SELECT 1 FROM refs WHERE sha256 = ?", (sha,)).fetchone() is None]
+        for sha256 in orphaned:
+            _blob_path(sha256).unlink(missing_ok=True)
+            _vision_variant_path(sha256).unlink(missing_ok=True)
+            _extraction_cache_path(sha256).unlink(missing_ok=True) # Don't keep the document's plaintext either
+    if orphaned: vision_image_b64.cache_clear()
+
+def _build_vision_variant(blob_path, variant_path):
+    """Writes a downscaled, EXIF-rotated RGB JPEG of an image (runs in the extraction pool)."""
+    with Image.open(blob_path) as img:
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((VISION_IMAGE_MAX_SIDE, VISION_IMAGE_MAX_SIDE))
+        buffer = BytesIO()
+        img.convert('RGB').save(buffer, 'JPEG', quality=VISION_IMAGE_JPEG_QUALITY)
+    Path(variant_path).parent.mkdir(parents=True, exist_ok=True)
+    _atomic_write_bytes(Path(variant_path), buffer.getvalue())
+
+def schedule_vision_variant(sha256):
+    """Builds the vision variant of an uploaded image in the background, if not built yet."""
+    if _vision_variant_path(sha256).exists(): return
+    try:
+        get_extraction_pool().submit(_build_vision_variant, _blob_path(sha256), _vision_variant_path(sha256))
+    except Exception as e:
+        log_event(logging.WARNING, 'vision_variant_failed', "Could not schedule vision variant", sha256=sha256, error=str(e))
+
+@functools.lru_cache(maxsize=VISION_B64_CACHE_SIZE)
+def vision_image_b64(sha256):
+    """Returns the base64 encoding of an image's vision variant, building the variant if needed."""
+    variant_path = _vision_variant_path(sha256)
+    if not variant_path.exists():
+        _build_vision_variant(_blob_path(sha256), variant_path)
+    return base64.b64encode(variant_path.read_bytes()).decode('utf-8')
+
+# --- Document Extraction (background process pool) ---
+# PDF pages and DOCX files are parsed in a process pool so several large uploads run in parallel
+# (PDFs are split into page ranges) without holding the GIL of the request thread. Extracted text
+# is cached by content hash, so the same file uploaded again is never parsed twice.
+_extraction_pool = None
+_extraction_pool_lock = threading.Lock()
+
+def get_extraction_pool():
+    global _extraction_pool
+    with _extraction_pool_lock:
+        if _extraction_pool is None:
+            # Forking a process that runs Flask/ollama threads can copy held locks into the child,
+            # so workers come from a fresh forkserver (spawn where it is not available).
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _extraction_pool = ProcessPoolExecutor(max_workers=EXTRACTION_WORKERS, mp_context=multiprocessing.get_context(start_method))
+        return _extraction_pool
+
+def _extract_pdf_pages(path, start, end):
+    with fitz.open(path) as doc:
+        return "".join(doc[i].get_text() for i in range(start, end))
+
+def _extract_docx_text(path):
+    document = docx.Document(path)
+    return "\n".join([para.text for para in document.paragraphs])
+
+def _extract_plain_text(path):
+    with open(path, 'rb') as f:
+        return f.read().decode('utf-8', errors='replace')
+
+def _document_label(saved_file):
+    """Returns the label used in the extracted text header, or None if the file has no text."""
+    name = saved_file['original_filename'].lower()
+    if name.endswith('.pdf'): return 'PDF'
+    if name.endswith('.docx'): return 'DOCX'
+    if saved_file['content_type'].startswith('text/'): return 'Text File'
+    return None
+
+def _extraction_cache_path(sha256):
+    return EXTRACTION_CACHE_DIR / f"{sha256}.txt"
+
+def _submit_extraction(pool, saved_file, label):
+    """Submits the extraction of one file and returns its futures in document order."""
+    path = str(saved_file['path'])
+    if label == 'PDF':
+        with fitz.open(path) as doc: page_count = doc.page_count
+        return [
+            pool.submit(_extract_pdf_pages, path, start, min(start + PDF_PAGES_PER_TASK, page_count))
+            for start in range(0, page_count, PDF_PAGES_PER_TASK)
+        ]
+    if label == 'DOCX':
+        return [pool.submit(_extract_docx_text, path)]
+    return [pool.submit(_extract_plain_text, path)]
+
+def extract_attachment_texts(chat_id, saved_files):
+    """
+    Generator that extracts the text of saved uploads in the background, yielding short progress
+    strings as parts complete. Its return value is the combined extracted text, with one
+    '--- Content from <type>: <name> ---' section per document. Each document is also added to
+    the chat's retrieval index.
+    """
+    started = time.monotonic()
+    documents = [(f, _document_label(f)) for f in saved_files]
+    documents = [(f, label) for f, label in documents if label]
+    texts = {} # Index into documents -> extracted text (None if extraction failed)
+    pending = {} # Future -> (document index, part index)
+    parts = {} # Document index -> list of part texts
+
+    for doc_index, (saved_file, label) in enumerate(documents):
+        cache_path = _extraction_cache_path(saved_file['sha256'])
+        if cache_path.exists():
+            texts[doc_index] = cache_path.read_text(encoding='utf-8')
+            ATTACHMENT_EXTRACTION.observe(time.monotonic() - started, type=label, source='cache')
+            yield f"Using cached text for {saved_file['original_filename']}"
+            continue
         try:
-            if original_filename.lower().endswith('.pdf'):
-                with fitz.open(stream=file_content, filetype="pdf") as doc:
-                    text = "".join(page.get_text() for page in doc)
-                    extracted_text += f"\n\n--- Content from PDF: {original_filename} ---\n{text}\n"
-            elif original_filename.lower().endswith('.docx'):
-                document = docx.Document(BytesIO(file_content))
-                text = "\n".join([para.text for para in document.paragraphs])
-                extracted_text += f"\n\n--- Content from DOCX: {original_filename} ---\n{text}\n"
-            elif file.content_type.startswith('text/'):
-                text = file_content.decode('utf-8', errors='replace')
-                extracted_text += f"\n\n--- Content from Text File: {original_filename} ---\n{text}\n"
+            futures = _submit_extraction(get_extraction_pool(), saved_file, label)
         except Exception as e:
-            print(f"Error processing text from {original_filename}: {e}")
+            log_event(logging.ERROR, 'extraction_failed', "Error processing text from attachment", filename=saved_file['original_filename'], error=str(e))
+            texts[doc_index] = None
+            continue
+        parts[doc_index] = [None] * len(futures)
+        for part_index, future in enumerate(futures):
+            pending[future] = (doc_index, part_index)
+        if not futures: texts[doc_index] = ""
+
+    if pending:
+        yield f"Extracting text from {len(parts)} document(s)..."
+    for future in as_completed(pending):
+        doc_index, part_index = pending[future]
+        saved_file = documents[doc_index][0]
+        if texts.get(doc_index, "") is None: continue # An earlier part of this document failed
+        try:
+            parts[doc_index][part_index] = future.result()
+        except Exception as e:
+            log_event(logging.ERROR, 'extraction_failed', "Error processing text from attachment", filename=saved_file['original_filename'], error=str(e))
+            texts[doc_index] = None
+            continue
+        done = sum(p is not None for p in parts[doc_index])
+        if done == len(parts[doc_index]):
+            texts[doc_index] = "".join(parts[doc_index])
+            EXTRACTION_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            _atomic_write_text(_extraction_cache_path(saved_file['sha256']), texts[doc_index])
+            ATTACHMENT_EXTRACTION.observe(time.monotonic() - started, type=documents[doc_index][1], source='extracted')
+            yield f"Extracted {saved_file['original_filename']}"
+        else:
+            yield f"Extracting {saved_file['original_filename']}: {done}/{len(parts[doc_index])} parts"
+
+    extracted_text = ""
+    for doc_index, (saved_file, label) in enumerate(documents):
+        original_filename = saved_file['original_filename']
+        text = texts.get(doc_index)
+        if text is None:
             extracted_text += f"\n\n--- Could not extract text from {original_filename} ---\n"
+            continue
+        extracted_text += f"\n\n--- Content from {label}: {original_filename} ---\n{text}\n"
+        if text: index_attachment_text(chat_id, saved_file['stored_filename'], original_filename, text)
+    return extracted_text.strip()
+
+
+# --- Web Search (cached, concurrent) ---
+# The search tool goes through a pluggable backend (anything with a
+# search(query, max_results) -> [{'title', 'href', 'body'}] method) so tests and benchmarks can
+# swap in a local fake. Results are cached by backend and normalized query with a TTL, in a
+# bounded in-memory LRU backed by a small SQLite table, and several queries run concurrently.
+class DuckDuckGoSearchBackend:
+    def search(self, query, max_results):
+        with DDGS() as ddgs:
+            return list(ddgs.text(query, max_results=max_results))
+
+SEARCH_BACKENDS = {'duckduckgo': DuckDuckGoSearchBackend}
+_search_backend = SEARCH_BACKENDS[SEARCH_BACKEND]()
+_search_pool = ThreadPoolExecutor(max_workers=SEARCH_MAX_QUERIES * 2, thread_name_prefix='web-search')
+
+def set_search_backend(backend):
+    """Replaces the search backend (e.g. with a fake provider in tests). Cached results stay keyed by their backend."""
+    global _search_backend
+    _search_backend = backend
+
+def normalize_search_query(query):
+    return " ".join(query.lower().split())
 
-    return attachments_data, extracted_text.strip()
+def search_cache_key(backend, query):
+    """Cache key of a query: results of different backends never mix."""
+    return f"{type(backend).__name__}:{normalize_search_query(query)}"
 
+class WebSearchCache:
+    """TTL + LRU cache of search_cache_key() -> results, in memory and on disk."""
+    def __init__(self, path, max_entries, ttl):
+        self.path, self.max_entries, self.ttl = path, max_entries, ttl
+        self._memory = OrderedDict() # query -> (expires_at, results)
+        self._lock = threading.Lock()
 
-def _stream_response_generator(chat_id, chat_data, model):
+    @contextmanager
+    def _db(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            conn.execute("CREATE TABLE IF NOT EXISTS results (query TEXT PRIMARY KEY, results TEXT NOT NULL, expires_at REAL NOT NULL)")
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _remember(self, query, expires_at, results):
+        with self._lock:
+            self._memory[query] = (expires_at, results)
+            self._memory.move_to_end(query)
+            while len(self._memory) > self.max_entries: self._memory.popitem(last=False)
+
+    def get(self, query):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(query)
+            if entry and entry[0] > now:
+                self._memory.move_to_end(query)
+                return entry[1]
+        try:
+            with self._db() as conn:
+                row = conn.execute("SELECT results, expires_at FROM results WHERE query = ? AND expires_at > ?", (query, now)).fetchone()
+        except sqlite3.Error as e:
+            log_event(logging.WARNING, 'search_cache_read_failed', "Could not read web search cache", error=str(e))
+            return None
+        if row is None: return None
+        results = json.loads(row[0])
+        self._remember(query, row[1], results)
+        return results
+
+    def put(self, query, results):
+        expires_at = time.time() + self.ttl
+        self._remember(query, expires_at, results)
+        try:
+            with self._db() as conn:
+                conn.execute("INSERT OR REPLACE INTO results (query, results, expires_at) VALUES (?, ?, ?)", (query, json.dumps(results), expires_at))
+                conn.execute("DELETE FROM results WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            log_event(logging.WARNING, 'search_cache_write_failed', "Could not write web search cache", error=str(e))
+
+    def clear(self):
+        with self._lock: self._memory.clear()
+        try:
+            with self._db() as conn: conn.execute("DELETE FROM results")
+        except sqlite3.Error as e:
+            log_event(logging.WARNING, 'search_cache_clear_failed', "Could not clear web search cache", error=str(e))
+
+_search_cache = WebSearchCache(SEARCH_CACHE_FILE, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+def _cached_search(query):
+    backend = _search_backend # The backend may be replaced while this query runs
+    key = search_cache_key(backend, query)
+    results = _search_cache.get(key)
+    WEB_SEARCH_CACHE.inc(result='miss' if results is None else 'hit')
+    if results is None:
+        with WEB_SEARCH_LATENCY.time(backend=type(backend).__name__):
+            results = backend.search(query, SEARCH_MAX_RESULTS)
+        _search_cache.put(key, results)
+    return results
+
+def run_web_searches(queries, timeout=SEARCH_TIMEOUT):
+    """
+    Runs several searches concurrently. Returns a list of (query, results, error) in the order
+    of the queries; a query that fails or exceeds the timeout has results=None and an error.
+    """
+    futures = [(query, _search_pool.submit(_cached_search, query)) for query in queries]
+    deadline = time.monotonic() + timeout
+    outcomes = []
+    for query, future in futures:
+        try:
+            outcomes.append((query, future.result(timeout=max(0, deadline - time.monotonic())), None))
+        except FutureTimeoutError:
+            outcomes.append((query, None, f"timed out after {timeout}s"))
+        except Exception as e:
+            outcomes.append((query, None, str(e)))
+    return outcomes
+
+# --- Inference Scheduling ---
+# Every call to Ollama goes through one scheduler, which limits how many requests run at once
+# (globally and per model), serves interactive answers before background work such as titles,
+# and groups queued requests by model so Ollama does not thrash between loaded models: a request
+# for a cold model waits while requests for an already-running model are queued, unless it has
+# waited longer than SCHEDULER_MAX_BATCH_WAIT.
+class InferenceTicket:
+    """A queued or running request for an inference slot. Always release() it when done."""
+    def __init__(self, scheduler, model, priority, seq):
+        self.scheduler, self.model, self.priority, self.seq = scheduler, model, priority, seq
+        self.enqueued_at = time.monotonic()
+        self.granted_at = None
+        self.granted = threading.Event()
+        self.released = False
+        self._granted_callbacks = [] # Called (from the granting thread) once the slot is granted
+
+    def on_granted(self, callback):
+        """Calls `callback()` once the slot is granted, right away if it already is. Used by asgi.py."""
+        with self.scheduler._lock:
+            if not self.granted.is_set():
+                self._granted_callbacks.append(callback)
+                return
+        callback()
+
+    def wait(self, timeout=None):
+        """Waits up to `timeout` seconds for the slot. Returns True once it is granted."""
+        if self.granted.wait(timeout): return True
+        self.scheduler.dispatch() # Re-evaluate, e.g. this ticket may now have waited long enough
+        return self.granted.is_set()
+
+    def position(self):
+        return self.scheduler.position(self)
+
+    def release(self):
+        self.scheduler.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class InferenceScheduler:
+    def __init__(self, max_concurrent, default_model_limit, model_limits, max_batch_wait):
+        self.max_concurrent = max_concurrent
+        self.default_model_limit = default_model_limit
+        self.model_limits = model_limits
+        self.max_batch_wait = max_batch_wait
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._running = Counter()
+        self._last_model = None
+        self._seq = itertools.count()
+
+    def submit(self, model, priority=PRIORITY_INTERACTIVE):
+        with self._lock:
+            ticket = InferenceTicket(self, model, priority, next(self._seq))
+            self._waiting.append(ticket)
+            self._dispatch_locked()
+        return ticket
+
+    @contextmanager
+    def slot(self, model, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """Blocks until a slot is free (TimeoutError after `timeout` seconds) and holds it."""
+        ticket = self.submit(model, priority)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not ticket.wait(SCHEDULER_STATUS_INTERVAL):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise TimeoutError(f"No inference slot for {model} within {timeout}s")
+            yield ticket
+        finally:
+            ticket.release()
+
+    def release(self, ticket):
+        with self._lock:
+            if ticket.released: return
+            ticket.released = True
+            if ticket.granted.is_set():
+                self._running[ticket.model] -= 1
+            else:
+                self._waiting.remove(ticket) # Cancelled while still queued
+            self._dispatch_locked()
+
+    def dispatch(self):
+        with self._lock: self._dispatch_locked()
+
+    def try_acquire(self, model, priority=PRIORITY_BACKGROUND):
+        """Returns a granted ticket only if nothing is running or queued, otherwise None (never waits)."""
+        with self._lock:
+            if self._waiting or sum(self._running.values()): return None
+            ticket = InferenceTicket(self, model, priority, next(self._seq))
+            self._waiting.append(ticket)
+            self._dispatch_locked()
+        return ticket
+
+    def position(self, ticket):
+        """1-based position of a queued ticket in dispatch order (0 once it is running)."""
+        with self._lock:
+            if ticket not in self._waiting: return 0
+            now = time.monotonic()
+            return sorted(self._waiting, key=lambda t: self._sort_key(t, now)).index(ticket) + 1
+
+    def stats(self):
+        with self._lock:
+            return {"running": dict(+self._running), "queued": dict(Counter(t.model for t in self._waiting))}
+
+    def _is_warm(self, model):
+        return self._running[model] > 0 or model == self._last_model
+
+    def _is_starving(self, ticket, now):
+        return now - ticket.enqueued_at > self.max_batch_wait
+
+    def _sort_key(self, ticket, now):
+        return (ticket.priority, not self._is_starving(ticket, now), not self._is_warm(ticket.model), ticket.seq)
+
+    def _dispatch_locked(self):
+        now = time.monotonic()
+        for ticket in sorted(self._waiting, key=lambda t: self._sort_key(t, now)):
+            if sum(self._running.values()) >= self.max_concurrent: break
+            if self._running[ticket.model] >= self.model_limits.get(ticket.model, self.default_model_limit): continue
+            if not self._is_warm(ticket.model) and not self._is_starving(ticket, now) and any(
+                t.priority <= ticket.priority and self._is_warm(t.model) for t in self._waiting
+            ):
+                continue # Batch: let queued requests for the loaded model go first
+            self._waiting.remove(ticket)
+            self._running[ticket.model] += 1
+            self._last_model = ticket.model
+            ticket.granted_at = now
+            ticket.granted.set()
+            for callback in ticket._granted_callbacks: callback()
+            INFERENCE_QUEUE_WAIT.observe(now - ticket.enqueued_at, model=ticket.model, priority=PRIORITY_NAMES[ticket.priority])
+
+inference_scheduler = InferenceScheduler(OLLAMA_MAX_CONCURRENT, DEFAULT_MODEL_CONCURRENCY, MODEL_CONCURRENCY, SCHEDULER_MAX_BATCH_WAIT)
+MetricGauge('chat_inference_running', 'Requests currently running on Ollama.',
+            lambda: [({"model": model}, count) for model, count in inference_scheduler.stats()["running"].items()])
+MetricGauge('chat_inference_queued', 'Requests waiting for an inference slot.',
+            lambda: [({"model": model}, count) for model, count in inference_scheduler.stats()["queued"].items()])
+
+class StreamStatus(str):
+    """Progress message yielded by the response generator; not part of the answer text."""
+
+class StreamSegment(str):
+    """Answer text with a meaning of its own (search notice, sources list) for typed stream events."""
+    def __new__(cls, text, kind, **data):
+        segment = super().__new__(cls, text)
+        segment.kind = kind
+        segment.data = data
+        return segment
+
+class StreamUsage(dict):
+    """Token counts and timings reported by Ollama for the answer; not part of the answer text."""
+
+class StreamTimings(dict):
+    """Seconds spent in each stage of the turn (extraction, queue, search, ...); not part of the answer text."""
+
+def _answer_text_only(generator):
+    """Drops StreamStatus items for endpoints that stream plain answer text."""
+    for chunk in generator:
+        if not isinstance(chunk, StreamStatus): yield chunk
+
+# --- Model Registry ---
+# The model catalog (ollama.list() plus capabilities and context length from ollama.show()) is
+# cached for MODEL_CATALOG_TTL seconds, and show() is only called again for models whose digest
+# changed. Pinned models (PINNED_MODELS and the MODEL_PREWARM_TOP most used ones) are requested
+# with PINNED_KEEP_ALIVE and pre-warmed in the background, so switching to the vision or title
+# model does not pay a cold load mid-conversation. Load durations reported by Ollama are kept
+# per model, split into cold and warm loads, for the model picker.
+def _capabilities_from_metadata(info, model_info):
+    """Capabilities of a model on Ollama versions whose show() does not report them yet."""
+    families = (info.get('details') or {}).get('families') or []
+    if any(key.endswith('.pooling_type') for key in model_info): return ['embedding']
+    capabilities = ['completion']
+    if any(family in ('clip', 'mllama') for family in families) or any('.vision.' in key for key in model_info):
+        capabilities.append('vision')
+    return capabilities
+
+class ModelRegistry:
+    def __init__(self, catalog_ttl, status_ttl, pinned_models, prewarm_top, prewarm_interval):
+        self.catalog_ttl, self.status_ttl = catalog_ttl, status_ttl
+        self.pinned_models, self.prewarm_top, self.prewarm_interval = tuple(pinned_models), prewarm_top, prewarm_interval
+        self._lock = threading.Lock()
+        self._catalog, self._catalog_at = None, 0.0
+        self._details = {} # Model name -> (digest, capabilities, context length)
+        self._loaded, self._loaded_at = set(), 0.0
+        self._loads = {} # Model name -> {'cold': deque, 'warm': deque} of load seconds
+        self._uses = Counter()
+        self._warming = set()
+        self._prewarmed_at = None
+
+    def catalog(self, refresh=False):
+        """All models in Ollama as [{'name', 'capabilities', 'contextLength'}]. Raises if Ollama is unreachable."""
+        with self._lock:
+            if not refresh and self._catalog is not None and time.monotonic() - self._catalog_at < self.catalog_ttl:
+                return self._catalog
+        models = []
+        for model_obj in ollama.list().get('models', []):
+            name = model_obj.get('name') or model_obj.get('model')
+            if not name: continue
+            capabilities, context_length = self._describe(name, model_obj.get('digest'))
+            models.append({"name": name, "capabilities": capabilities, "contextLength": context_length})
+        with self._lock:
+            self._catalog, self._catalog_at = models, time.monotonic()
+        self.prewarm()
+        return models
+
+    def _describe(self, name, digest):
+        with self._lock:
+            cached = self._details.get(name)
+        if cached and cached[0] == digest: return cached[1:]
+        try:
+            info = ollama.show(name)
+        except Exception as e:
+            log_event(logging.WARNING, 'model_show_failed', "Could not read model metadata", model=name, error=str(e))
+            return [], None # Not cached, so the next refresh tries again
+        model_info = info.get('modelinfo') or info.get('model_info') or {}
+        capabilities = list(info.get('capabilities') or []) or _capabilities_from_metadata(info, model_info)
+        context_length = next((value for key, value in model_info.items() if key.endswith('.context_length')), None)
+        with self._lock:
+            self._details[name] = (digest, capabilities, context_length)
+        return capabilities, context_length
+
+    def capabilities(self, name):
+        """Capabilities of an installed model, e.g. {'completion', 'vision'}; empty if unknown or Ollama is down."""
+        try:
+            catalog = self.catalog()
+        except Exception:
+            return set()
+        return next((set(m["capabilities"]) for m in catalog if m["name"] == name), set())
+
+    def context_length(self, name):
+        """Native context length of an installed model; None if unknown or Ollama is down."""
+        try:
+            catalog = self.catalog()
+        except Exception:
+            return None
+        return next((m["contextLength"] for m in catalog if m["name"] == name), None)
+
+    def loaded_models(self):
+        """Names of the models Ollama currently has in memory (via ollama.ps())."""
+        with self._lock:
+            if time.monotonic() - self._loaded_at < self.status_ttl: return self._loaded
+        try:
+            loaded = {m.get('name') or m.get('model') for m in ollama.ps().get('models', [])}
+        except Exception:
+            loaded = set()
+        with self._lock:
+            self._loaded, self._loaded_at = loaded, time.monotonic()
+        return loaded
+
+    def record_use(self, name):
+        with self._lock:
+            self._uses[name] += 1
+
+    def pinned(self):
+        with self._lock:
+            return set(self.pinned_models) | {name for name, _ in self._uses.most_common(self.prewarm_top)}
+
+    def keep_alive(self, name):
+        """The keep_alive to send with a request for `name` (None: Ollama's default)."""
+        return PINNED_KEEP_ALIVE if name in self.pinned() else None
+
+    def record_load(self, name, seconds):
+        kind = 'cold' if seconds >= MODEL_COLD_LOAD_SECONDS else 'warm'
+        MODEL_LOADS.inc(model=name, kind=kind)
+        with self._lock:
+            loads = self._loads.setdefault(name, {'cold': deque(maxlen=MODEL_LOAD_SAMPLES), 'warm': deque(maxlen=MODEL_LOAD_SAMPLES)})
+            loads[kind].append(seconds)
+
+    def load_times(self, name):
+        """Median recent cold and warm load seconds of a model (None where none were seen)."""
+        with self._lock:
+            loads = self._loads.get(name, {})
+            return {kind: round(statistics.median(loads[kind]), 3) if loads.get(kind) else None for kind in ('cold', 'warm')}
+
+    def prewarm(self):
+        """
+        Loads one pinned model that is installed but not in memory (the most used first), at most
+        every prewarm_interval seconds and only while the inference scheduler is idle, so
+        pre-warming never competes with chats for Ollama's memory.
+        """
+        with self._lock:
+            if self._warming or (self._prewarmed_at is not None and time.monotonic() - self._prewarmed_at < self.prewarm_interval): return
+            installed = {m["name"] for m in self._catalog or []}
+        candidates = (self.pinned() & installed) - self.loaded_models()
+        with self._lock:
+            candidates = sorted(candidates, key=lambda name: -self._uses[name])
+        if not candidates: return
+        ticket = inference_scheduler.try_acquire(candidates[0], PRIORITY_BACKGROUND)
+        if ticket is None: return # Busy; try again on a later catalog read
+        with self._lock:
+            self._prewarmed_at = time.monotonic()
+        self.warm_async(candidates[0], ticket)
+
+    def warm_async(self, name, ticket=None):
+        """
+        Starts loading a model in the background, unless that is already under way. Without a
+        granted `ticket` it queues for a background inference slot first.
+        """
+        with self._lock:
+            if name in self._warming:
+                if ticket: ticket.release()
+                return
+            self._warming.add(name)
+        threading.Thread(target=self._warm, args=(name, ticket), name=f"warm-{name}", daemon=True).start()
+
+    def _warm(self, name, ticket):
+        try:
+            with ticket or inference_scheduler.slot(name, PRIORITY_BACKGROUND, timeout=MODEL_WARM_QUEUE_TIMEOUT):
+                # A chat request without messages only loads the model. Send the num_ctx real requests
+                # use, or Ollama reloads the model for the first of them anyway.
+                response = ollama.chat(model=name, messages=[], options={'num_ctx': context_token_budget(name)}, keep_alive=self.keep_alive(name))
+            load_seconds = (response.get('load_duration') or 0) / 1e9
+            self.record_load(name, load_seconds)
+            log_event(logging.INFO, 'model_warmed', "Model loaded ahead of use", model=name, load_seconds=load_seconds)
+        except Exception as e:
+            log_event(logging.WARNING, 'model_warm_failed', "Could not pre-warm model", model=name, error=str(e))
+        finally:
+            with self._lock:
+                self._warming.discard(name)
+                self._loaded_at = 0.0 # Re-read the loaded models next time
+
+model_registry = ModelRegistry(MODEL_CATALOG_TTL, MODEL_STATUS_TTL, PINNED_MODELS, MODEL_PREWARM_TOP, MODEL_PREWARM_INTERVAL)
+
+# --- Response Generation ---
+# The pieces of a chat turn that do no network I/O live in helpers, so the same logic drives
+# both the threaded generator below and the coroutine-based one in asgi.py.
+def prepare_chat_turn(chat_id, chat_data, model):
+    """
+    Chooses the model for the turn (switching to the vision model for images, unless the chosen
+    model can see them itself) and builds the prompt. Returns (final_model, messages_for_api, llm_options).
+    """
+    model_has_vision = 'vision' in model_registry.capabilities(model) # Cached; looked up outside the chat lock
+    with chat_lock(chat_id):
+        # Snapshot the chat as it is now, e.g. including text extracted after chat_data was read.
+        # Token counts are cached on the shared messages first, so the copies carry them along.
+        messages = (load_chat_history(chat_id) or chat_data)['messages']
+        for message in messages: message_token_count(message)
+        messages = [dict(message) for message in messages]
+    # Retrieval, image encoding and prompt assembly run on the copies, without holding the lock
+    final_model, messages_for_api, llm_options = _prepare_chat_turn_messages(chat_id, messages, model, model_has_vision)
+    model_registry.record_use(final_model)
+    return final_model, messages_for_api, llm_options
+
+def has_image_attachments(message):
+    return any(att.get('type', '').startswith('image/') for att in message.get('attachments', []))
+
+def _prepare_chat_turn_messages(chat_id, messages, model, model_has_vision=False):
+    final_model = model
+    # Determine if any images are in the last user message
+    has_images = has_image_attachments(messages[-1])
+    if has_images and not model_has_vision:
+        final_model = FIXED_VISION_MODEL
+        log_event(logging.INFO, 'vision_model_selected', "Image detected, switching to vision model", chat_id=chat_id, model=final_model)
+
+    # Check for web search activation
+    is_web_search_turn = messages[-1].get('content', '').startswith('[Web Search Activated]')
+    extra_tokens = estimate_tokens(WEB_SEARCH_SYSTEM_PROMPT) if is_web_search_turn else 0
+    messages_with_context = attach_retrieved_context(chat_id, messages)
+    messages_to_process = build_context_window(messages_with_context, final_model, extra_tokens)
+    llm_options = {'num_ctx': context_token_budget(final_model)}
+    if is_web_search_turn:
+        # Temporarily modify the message list for this turn to include the system prompt
+        search_messages = copy.deepcopy(messages_to_process)
+        search_messages[-1]['content'] = search_messages[-1]['content'].replace('[Web Search Activated]', '').strip()
+        search_messages.insert(0, {'role': 'system', 'content': WEB_SEARCH_SYSTEM_PROMPT})
+        messages_for_api = prepare_messages_for_llm(search_messages)
+    else:
+        messages_for_api = prepare_messages_for_llm(messages_to_process, include_images=has_images, chat_id=chat_id)
+    return final_model, messages_for_api, llm_options
+
+class SearchTagDetector:
+    """
+    Classifies a streamed answer in a single pass: holds back only the characters that could
+    still become a <search> tag, then either passes text straight through or collects the
+    tool call until its closing tag.
+    """
+    def __init__(self):
+        self.pending = ""
+        self.is_tool_call = None # None = undecided, True = <search> prefix, False = normal answer
+
+    def feed(self, content_piece):
+        """Consumes a streamed piece and returns the text that can be forwarded right away."""
+        if self.is_tool_call is False: return content_piece
+        self.pending += content_piece
+        if self.is_tool_call is None:
+            head = self.pending.lstrip()
+            if head.startswith(SEARCH_TAG_OPEN):
+                self.is_tool_call = True
+            elif not SEARCH_TAG_OPEN.startswith(head):
+                self.is_tool_call = False
+                forward, self.pending = self.pending, ""
+                return forward
+        return ""
+
+    @property
+    def tool_call_complete(self):
+        return bool(self.is_tool_call) and SEARCH_TAG_CLOSE in self.pending
+
+    def search_match(self):
+        return re.search(r'<search>(.*?)</search>', self.pending, re.DOTALL) if self.is_tool_call else None
+
+def parse_search_queries(search_match):
+    """Returns the queries of a <search> block, accepting {"query": ...} or {"queries": [...]}."""
+    search_data = json.loads(search_match.group(1).strip())
+    if not isinstance(search_data, dict):
+        raise ValueError(f"The search command must be a JSON object, not {type(search_data).__name__}.")
+    search_queries = search_data.get('queries') or search_data.get('query')
+    if isinstance(search_queries, str): search_queries = [search_queries] # A single query, not a list of characters
+    if not isinstance(search_queries, list): search_queries = []
+    search_queries = [q.strip() for q in search_queries if isinstance(q, str) and q.strip()][:SEARCH_MAX_QUERIES]
+    if not search_queries: raise ValueError("The search command did not contain a query.")
+    return search_queries
+
+def format_search_results(outcomes, sources_used):
+    """Formats run_web_searches() outcomes for the model and records the sources used."""
+    if all(error for _, _, error in outcomes):
+        raise RuntimeError("; ".join(f"'{q}': {error}" for q, _, error in outcomes))
+    results_text = ""
+    for search_query, search_results, error in outcomes:
+        if error:
+            results_text += f"Search for '{search_query}' failed: {error}\n\n"
+            continue
+        results_text += f"Search results for '{search_query}':\n\n"
+        for i, result in enumerate(search_results):
+            results_text += f"Result {i+1}:\nTitle: {result['title']}\nURL: {result['href']}\nSnippet: {result['body']}\n\n"
+            sources_used.append({"title": result['title'], "url": result['href'], "query": search_query})
+    return results_text
+
+def format_sources_markdown(sources_used):
+    sources_markdown = "\n\n---\n**Sources:**\n"
+    for i, source in enumerate(sources_used):
+        sources_markdown += f"{i+1}. [{source['title']}]({source['url']}) - *Query: {source['query']}*\n"
+    return sources_markdown
+
+def add_usage(usage, chunk):
+    """Adds the counters of Ollama's final stream chunk (the one with done=True) to `usage`."""
+    for key in ('prompt_eval_count', 'prompt_eval_duration', 'eval_count', 'eval_duration', 'load_duration', 'total_duration'):
+        usage[key] = usage.get(key, 0) + (chunk.get(key) or 0)
+
+def record_first_token(timings, model, started):
+    """Records the time to the first answer token of a turn whose generation began at `started`."""
+    timings["time_to_first_token"] = time.monotonic() - started
+    TIME_TO_FIRST_TOKEN.observe(timings["time_to_first_token"], model=model)
+
+def queue_status(ticket):
+    return StreamStatus(f"Waiting for {ticket.model} (position {ticket.position()} in queue)")
+
+def save_assistant_response(chat_id, content, model, message_index):
+    """
+    Appends a final or partial answer to the chat as message `message_index`. The answer is
+    discarded if the chat was deleted or no longer has exactly `message_index` messages, since
+    it would then follow the wrong (or a deleted) user turn.
+    """
+    final_ai_message = {'role': 'assistant', 'content': content, 'model': model}
+    message_token_count(final_ai_message)
+    with chat_lock(chat_id):
+        # Append to the chat as it is now (usually served from the cache), so changes made
+        # while the answer streamed are kept.
+        chat_data = load_chat_history(chat_id)
+        if chat_data is None or len(chat_data['messages']) != message_index:
+            log_event(logging.WARNING, 'answer_discarded', "Chat changed while the answer was generated, discarding it",
+                      chat_id=chat_id, expected_index=message_index, message_count=None if chat_data is None else len(chat_data['messages']))
+            return
+        log_event(logging.INFO, 'answer_saved', "Saving final/partial response", chat_id=chat_id, model=model, length=len(content))
+        update_chat_history(chat_id, chat_data, {"op": "append", "message": final_ai_message})
+
+def _stream_response_generator(chat_id, chat_data, model, message_index):
     """
     Core generator for handling chat responses. It supports multi-step tool use (web search)
-    and ensures that even interrupted responses are saved correctly.
+    and ensures that even interrupted responses are saved correctly, as message `message_index`.
     """
     full_response_content = ""
     final_model = model
     sources_used = []
+    usage = StreamUsage()
+    timings = StreamTimings()
+    started = time.monotonic()
+    ticket = None
+    stream = None
     
     try:
-        messages_to_process = list(chat_data['messages'])[-CONTEXT_WINDOW_MESSAGES:]
-        
-        # Determine if any images are in the last user message
-        has_images = any(
-            att.get('type', '').startswith('image/') 
-            for att in messages_to_process[-1].get('attachments', [])
-        )
-        if has_images:
-            final_model = FIXED_VISION_MODEL
-            print(f"Image detected. Switching to vision model: {final_model}")
-
-        # Check for web search activation
-        is_web_search_turn = messages_to_process[-1].get('content', '').startswith('[Web Search Activated]')
-        if is_web_search_turn:
-            # Temporarily modify the message list for this turn to include the system prompt
-            search_messages = copy.deepcopy(messages_to_process)
-            search_messages[-1]['content'] = search_messages[-1]['content'].replace('[Web Search Activated]', '').strip()
-            search_messages.insert(0, {'role': 'system', 'content': WEB_SEARCH_SYSTEM_PROMPT})
-            messages_for_api = prepare_messages_for_llm(search_messages)
-        else:
-            messages_for_api = prepare_messages_for_llm(messages_to_process, include_images=has_images, chat_id=chat_id)
+        final_model, messages_for_api, llm_options = prepare_chat_turn(chat_id, chat_data, model)
+
+        # Wait for an inference slot, reporting the queue position while waiting
+        ticket = inference_scheduler.submit(final_model, PRIORITY_INTERACTIVE)
+        while not ticket.wait(SCHEDULER_STATUS_INTERVAL):
+            yield queue_status(ticket)
+        timings["queue_wait"] = ticket.granted_at - ticket.enqueued_at
 
         # Main loop for tool use (e.g., search -> answer)
-        for _ in range(3): # Max 3 tool uses to prevent infinite loops
-            response = ollama.chat(model=final_model, messages=messages_for_api)
-            assistant_message = response['message']
-            search_match = re.search(r'<search>(.*?)</search>', assistant_message['content'], re.DOTALL)
+        for _ in range(MAX_TOOL_ROUNDS): # Limit tool uses to prevent infinite loops
+            # Single streaming pass: forward tokens directly unless the answer starts with <search>
+            stream = ollama.chat(model=final_model, messages=messages_for_api, stream=True, options=llm_options, keep_alive=model_registry.keep_alive(final_model))
+            detector = SearchTagDetector()
+            for chunk in stream:
+                forward = detector.feed(chunk['message'].get('content') or '')
+                if forward:
+                    if "time_to_first_token" not in timings: record_first_token(timings, final_model, started)
+                    full_response_content += forward
+                    yield forward
+                if chunk.get('done'): add_usage(usage, chunk)
+                if detector.tool_call_complete: break # Stop generating once the tool call is complete
+            if hasattr(stream, 'close'): stream.close()
+            search_match = detector.search_match()
 
             if not search_match: # No tool use, this is the final answer
-                stream = ollama.chat(model=final_model, messages=messages_for_api, stream=True)
-                for chunk in stream:
-                    if 'content' in chunk['message']:
-                        content_piece = chunk['message']['content']
-                        full_response_content += content_piece
-                        yield content_piece
-                
+                if detector.pending: # Stream ended while the prefix was still ambiguous or the tag was never closed
+                    full_response_content += detector.pending
+                    yield detector.pending
+
                 if sources_used:
-                    sources_markdown = "\n\n---\n**Sources:**\n"
-                    for i, source in enumerate(sources_used):
-                        sources_markdown += f"{i+1}. [{source['title']}]({source['url']}) - *Query: {source['query']}*\n"
+                    sources_markdown = format_sources_markdown(sources_used)
                     full_response_content += sources_markdown
-                    yield sources_markdown
+                    yield StreamSegment(sources_markdown, 'sources', sources=sources_used)
+                if usage:
+                    timings.update(record_ollama_usage(final_model, usage))
+                    yield usage
+                yield timings
                 return # End the generator successfully
 
             # Tool use detected (Web Search)
             try:
-                search_json_str = search_match.group(1).strip()
-                search_data = json.loads(search_json_str)
-                search_query = search_data['query']
-                print(f"Model requested search for: '{search_query}'")
-                search_status_msg = f"Searching the web for: `{search_query}`\n\n"
+                search_queries = parse_search_queries(search_match)
+                log_event(logging.INFO, 'web_search_requested', "Model requested web search", chat_id=chat_id, queries=search_queries)
+                search_status_msg = f"Searching the web for: {', '.join(f'`{q}`' for q in search_queries)}\n\n"
                 full_response_content += search_status_msg
-                yield search_status_msg
+                yield StreamSegment(search_status_msg, 'search', queries=search_queries)
 
-                with DDGS() as ddgs: search_results = list(ddgs.text(search_query, max_results=5))
-
-                results_text = f"Search results for '{search_query}':\n\n"
-                for i, result in enumerate(search_results):
-                    results_text += f"Result {i+1}:\nTitle: {result['title']}\nURL: {result['href']}\nSnippet: {result['body']}\n\n"
-                    sources_used.append({"title": result['title'], "url": result['href'], "query": search_query})
-                
-                messages_for_api.append(assistant_message)
+                search_started = time.monotonic()
+                results_text = format_search_results(run_web_searches(search_queries), sources_used)
+                timings["web_search"] = timings.get("web_search", 0) + time.monotonic() - search_started
+                messages_for_api.append({'role': 'assistant', 'content': detector.pending.strip()})
                 messages_for_api.append({'role': 'user', 'content': results_text})
             except Exception as e:
-                print(f"Error during search tool use: {e}")
+                log_event(logging.ERROR, 'web_search_failed', "Error during search tool use", chat_id=chat_id, error=str(e))
                 error_msg = f"An error occurred while trying to perform a web search: {e}"
                 full_response_content += error_msg
                 yield error_msg
                 return
 
     except GeneratorExit:
-        print(f"Stream for chat {chat_id} was aborted by the client.")
+        log_event(logging.INFO, 'generation_stopped', "Generation was stopped before it finished", chat_id=chat_id)
     except Exception as e:
-        print(f"An unexpected error occurred in the generator for chat {chat_id}: {e}")
-        traceback.print_exc()
+        log_event(logging.ERROR, 'generation_error', "Unexpected error while generating an answer", exc_info=True, chat_id=chat_id)
         yield f"An unexpected error occurred: {str(e)}"
     finally:
+        # Closing the Ollama stream drops its connection, which makes Ollama stop generating.
+        if stream is not None and hasattr(stream, 'close'): stream.close()
+        if ticket is not None: ticket.release()
         # This block executes on successful completion OR when the client disconnects (GeneratorExit).
         # This is the CRITICAL part that ensures interrupted responses are saved.
         if full_response_content:
-            print(f"Saving final/partial response for chat {chat_id}. Length: {len(full_response_content)}")
-            final_ai_message = {'role': 'assistant', 'content': full_response_content, 'model': final_model}
-            current_chat_data = load_chat_history(chat_id)
-            if current_chat_data:
-                # Append the new message, ensuring it's not a duplicate from a previous failed save
-                if not current_chat_data['messages'] or current_chat_data['messages'][-1] != final_ai_message:
-                    current_chat_data['messages'].append(final_ai_message)
-                    save_chat_history(chat_id, current_chat_data)
+            save_assistant_response(chat_id, full_response_content, final_model, message_index)
+
+# --- Detached Generation Jobs ---
+# Answers are generated by server-side jobs that are not tied to the HTTP response: a dropped
+# connection no longer throws away the GPU work, and a client can reattach to a running job and
+# replay its text from any offset still held in the job's ring buffer. Only an explicit cancel
+# stops a job early (the partial answer is then saved as before). A chat has at most one running
+# job: it is registered under the chat lock together with the history change it answers, and
+# requests that would change the history meanwhile are refused with 409 and the running job's id.
+class JobOffsetExpired(Exception):
+    """The requested offset has already been dropped from the job's ring buffer."""
+
+class GenerationJob:
+    def __init__(self, chat_id):
+        self.id = uuid.uuid4().hex
+        self.chat_id = chat_id
+        self.message_index = None # Index the answer will get in the chat (see register_generation_job)
+        self.created_at = time.time()
+        self.finished_at = None
+        self.cancelled = False
+        self.status = None # Latest StreamStatus text, until the answer starts
+        self.usage = None # StreamUsage of the finished answer, if Ollama reported it
+        self.timings = {} # StreamTimings of the turn, merged as stages report them
+        self.base_offset = 0 # Absolute offset of the first character still buffered
+        self._chunks = [] # Buffered answer text...
+        self._ends = [] # ...and the absolute end offset of each chunk
+        self._version = 0
+        self._cond = threading.Condition()
+        self._listeners = [] # Called on every change, for followers that cannot block on _cond (asgi.py)
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    @property
+    def length(self):
+        return self._ends[-1] if self._ends else self.base_offset
+
+    def _changed_locked(self):
+        self._version += 1
+        self._cond.notify_all()
+        for listener in self._listeners: listener()
+
+    def add_listener(self, listener):
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._cond:
+            self._listeners.remove(listener)
+
+    def append(self, text):
+        with self._cond:
+            self._chunks.append(text)
+            self._ends.append(self.length + len(text))
+            # Trim the ring buffer in batches once it holds twice the limit (amortized O(1))
+            if self.length - self.base_offset > 2 * JOB_BUFFER_CHARS:
+                cut = bisect.bisect_left(self._ends, self.length - JOB_BUFFER_CHARS)
+                if cut > 0:
+                    self.base_offset = self._ends[cut - 1]
+                    del self._chunks[:cut], self._ends[:cut]
+            self._changed_locked()
+
+    def set_status(self, status):
+        with self._cond:
+            self.status = status
+            self._changed_locked()
+
+    def set_usage(self, usage):
+        with self._cond:
+            self.usage = usage
+
+    def add_timings(self, timings):
+        with self._cond:
+            self.timings.update(timings)
+
+    def finish(self):
+        with self._cond:
+            self.finished_at = time.time()
+            self._changed_locked()
+
+    def cancel(self):
+        with self._cond:
+            self.cancelled = True
+            self._changed_locked()
+
+    def snapshot(self, offset):
+        """
+        Returns (version, pieces of answer text from offset, status, done) without blocking.
+        Adjacent plain text is joined into one piece; StreamSegments are kept as they are.
+        """
+        with self._cond:
+            return self._snapshot_locked(offset)
+
+    def _snapshot_locked(self, offset):
+        if offset < self.base_offset: raise JobOffsetExpired(f"Offset {offset} is no longer buffered (oldest is {self.base_offset}).")
+        i = bisect.bisect_right(self._ends, offset)
+        pieces = []
+        if i < len(self._chunks):
+            chunk_start = self._ends[i - 1] if i > 0 else self.base_offset
+            first = self._chunks[i]
+            pieces.append(first if offset == chunk_start else first[offset - chunk_start:]) # A cut segment is plain text
+            for chunk in self._chunks[i + 1:]:
+                if isinstance(chunk, StreamSegment) or isinstance(pieces[-1], StreamSegment): pieces.append(chunk)
+                else: pieces[-1] += chunk
+        return self._version, pieces, self.status, self.done
+
+    def _wait_for_batch_locked(self, offset):
+        """Lets answer text accumulate for up to STREAM_BATCH_INTERVAL, so it is written in fewer, larger pieces."""
+        deadline = time.monotonic() + STREAM_BATCH_INTERVAL
+        while not self.done and not self.cancelled and self.length - offset < STREAM_BATCH_CHARS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return
+            self._cond.wait(remaining)
+
+    def follow(self, offset=0):
+        """Yields StreamStatus updates and answer text from `offset` until the job is finished."""
+        version, last_status = -1, None
+        while True:
+            with self._cond:
+                while self._version == version: self._cond.wait()
+                if self.length > offset: self._wait_for_batch_locked(offset)
+                version, pieces, status, done = self._snapshot_locked(offset)
+            if status and status != last_status:
+                last_status = status
+                yield StreamStatus(status)
+            for piece in pieces:
+                offset += len(piece)
+                yield piece
+            if done: return
+
+_generation_jobs = {}
+_generation_jobs_lock = threading.Lock()
+
+def register_generation_job(chat_id, message_index):
+    """
+    Registers the job for the answer that becomes message `message_index`. Call it under chat_lock
+    right after changing the history for it (and after ensure_no_active_job before that change).
+    """
+    now = time.time()
+    with _generation_jobs_lock:
+        for job_id in [j.id for j in _generation_jobs.values() if j.done and now - j.finished_at > JOB_RETENTION_SECONDS]:
+            del _generation_jobs[job_id]
+        job = GenerationJob(chat_id)
+        job.message_index = message_index
+        _generation_jobs[job.id] = job
+    return job
+
+def get_generation_job(chat_id, job_id):
+    with _generation_jobs_lock:
+        job = _generation_jobs.get(job_id)
+    return job if job and job.chat_id == chat_id else None
+
+def get_active_job(chat_id):
+    with _generation_jobs_lock:
+        return next((j for j in _generation_jobs.values() if j.chat_id == chat_id and not j.done), None)
+
+def _active_job_counts():
+    with _generation_jobs_lock:
+        return [({}, sum(not j.done for j in _generation_jobs.values()))]
+
+MetricGauge('chat_generation_jobs_active', 'Generation jobs that have not finished yet.', _active_job_counts)
+
+def _run_generation_job(job, source):
+    outcome = 'completed'
+    try:
+        for item in source:
+            if job.cancelled: break
+            if isinstance(item, StreamStatus): job.set_status(item)
+            elif isinstance(item, StreamUsage): job.set_usage(item)
+            elif isinstance(item, StreamTimings): job.add_timings(item)
+            else: job.append(item)
+    except Exception as e:
+        outcome = 'failed'
+        log_event(logging.ERROR, 'generation_job_failed', "Generation job failed", exc_info=True, job_id=job.id, chat_id=job.chat_id)
+    finally:
+        source.close() # On cancel this saves the partial answer and stops Ollama
+        job.finish()
+        finish_generation_job(job, outcome)
+
+def finish_generation_job(job, outcome):
+    """Counts and logs a finished job, with its timings (see StreamTimings)."""
+    if job.cancelled: outcome = 'cancelled'
+    GENERATIONS.inc(outcome=outcome)
+    log_event(logging.INFO, 'generation_finished', "Generation job finished", job_id=job.id, chat_id=job.chat_id,
+              outcome=outcome, length=job.length, **job.timings)
+
+def ensure_no_active_job(chat_id):
+    """Raises ChatRequestError (409, with the job's id) while a job of the chat is still running."""
+    active_job = get_active_job(chat_id)
+    if active_job:
+        raise ChatRequestError("An answer is still being generated in this chat. Stop it or wait for it to finish.", 409, job_id=active_job.id)
+
+def start_generation_job(job, source):
+    """Runs a response generator for a registered GenerationJob in a background thread and returns the job."""
+    threading.Thread(target=_run_generation_job, args=(job, source), name=f"generation-{job.id}", daemon=True).start()
+    return job
+
+def _chat_turn_generator(chat_id, chat_data, model, user_message_index, saved_files):
+    """Extracts the new message's documents (yielding progress) and then generates the answer."""
+    if saved_files:
+        started = time.monotonic()
+        extraction = extract_attachment_texts(chat_id, saved_files)
+        try:
+            while True: yield StreamStatus(next(extraction))
+        except StopIteration as done:
+            store_extracted_text(chat_id, chat_data, user_message_index, done.value)
+        yield StreamTimings(extraction=time.monotonic() - started)
+    yield from _stream_response_generator(chat_id, chat_data, model, user_message_index + 1)
+
+# --- Request Handling Helpers ---
+# Validation and history updates shared by the Flask routes and the async entry point.
+class ChatRequestError(Exception):
+    """A request that cannot be served, with the HTTP status to answer with."""
+    def __init__(self, message, status=400, job_id=None):
+        super().__init__(message)
+        self.status = status
+        self.job_id = job_id # The running job a 409 refers to
+
+    @property
+    def headers(self):
+        return {'X-Job-Id': self.job_id} if self.job_id else {}
+
+    def to_dict(self):
+        return {"error": str(self), "jobId": self.job_id} if self.job_id else {"error": str(self)}
+
+def begin_user_turn(chat_id, model, prompt, files):
+    """
+    Validates a new user message, saves its uploads and appends it to the chat (creating the
+    chat if chat_id is None). Returns (chat_id, chat_data, user_message, saved_files, job) where
+    job is the registered, not yet started GenerationJob for the answer.
+    """
+    if not model: raise ChatRequestError("Model not provided")
+    if not prompt and not files: raise ChatRequestError("Cannot start a chat with an empty message.")
+
+    is_new_chat = not chat_id
+    if is_new_chat:
+        chat_id = str(uuid.uuid4())
+    elif not load_chat_history(chat_id):
+        raise ChatRequestError("Chat not found.", 404)
+    else:
+        ensure_no_active_job(chat_id) # Refuse early, before storing the uploads
+
+    attachments_data, saved_files = save_uploaded_files(chat_id, files) # Outside the chat lock; hashing can take a while
+    
+    user_message = {"role": "user", "content": prompt}
+    if attachments_data: user_message["attachments"] = attachments_data
+    message_token_count(user_message) # Cache token counts with the stored message
+    if has_image_attachments(user_message) and 'vision' not in model_registry.capabilities(model):
+        model_registry.warm_async(FIXED_VISION_MODEL) # Load it while documents are extracted and the turn queues
+    
+    with chat_lock(chat_id):
+        if is_new_chat:
+            chat_data = {"title": "New Chat", "messages": [user_message]}
+            save_chat_history(chat_id, chat_data)
+        else:
+            chat_data = load_chat_history(chat_id)
+            if not chat_data: raise ChatRequestError("Chat not found.", 404) # Deleted during the upload
+            ensure_no_active_job(chat_id)
+            update_chat_history(chat_id, chat_data, {"op": "append", "message": user_message})
+        job = register_generation_job(chat_id, len(chat_data['messages']))
+    return chat_id, chat_data, user_message, saved_files, job
+
+def store_extracted_text(chat_id, chat_data, message_index, extracted_text):
+    if not extracted_text: return
+    with chat_lock(chat_id):
+        current = load_chat_history(chat_id)
+        # Skip if the chat or the message was deleted while the documents were being extracted
+        if current is None or message_index >= len(current['messages']): return
+        if current['messages'][message_index].get('attachments') != chat_data['messages'][message_index].get('attachments'): return
+        update_chat_history(chat_id, current, {"op": "update", "index": message_index, "fields": {
+            "extracted_content": extracted_text, "extracted_token_count": estimate_tokens(extracted_text)
+        }})
+
+def begin_regeneration(chat_id, data):
+    """
+    Validates a regenerate request and prunes the chat before that answer. Returns
+    (chat_data, model, job) with the registered, not yet started GenerationJob.
+    """
+    model = data.get('model')
+    msg_index = data.get('msg_index')
+
+    if not model or msg_index is None: raise ChatRequestError("Model and message index not provided.")
+    with chat_lock(chat_id):
+        chat_data = load_chat_history(chat_id)
+        if not chat_data: raise ChatRequestError("Chat not found", 404)
+        if not (0 <= msg_index < len(chat_data['messages']) and chat_data['messages'][msg_index]['role'] == 'assistant'):
+            raise ChatRequestError("Invalid index for regeneration.")
+        ensure_no_active_job(chat_id)
+        
+        # Prune the conversation to the point *before* the message to be regenerated
+        update_chat_history(chat_id, chat_data, {"op": "truncate", "length": msg_index})
+        job = register_generation_job(chat_id, len(chat_data['messages']))
+    return chat_data, model, job
+
+def begin_edit(chat_id, data):
+    """
+    Validates an edit request, updates the user message and prunes after it. Returns
+    (chat_data, model, job) with the registered, not yet started GenerationJob.
+    """
+    model, msg_index, new_prompt = data.get('model'), data.get('msg_index'), data.get('new_prompt')
+
+    if not all([model, isinstance(msg_index, int), new_prompt is not None]): raise ChatRequestError("Missing required data.")
+    
+    with chat_lock(chat_id):
+        chat_data = load_chat_history(chat_id)
+        if not chat_data: raise ChatRequestError("Chat not found", 404)
+        if not (0 <= msg_index < len(chat_data['messages']) and chat_data['messages'][msg_index]['role'] == 'user'):
+            raise ChatRequestError("Invalid index for edit.")
+        ensure_no_active_job(chat_id)
+
+        # Update the user message and prune the history to that point
+        update_chat_history(chat_id, chat_data, {"op": "edit", "index": msg_index, "content": new_prompt, "token_count": message_token_count({"content": new_prompt})})
+        update_chat_history(chat_id, chat_data, {"op": "truncate", "length": msg_index + 1})
+        job = register_generation_job(chat_id, len(chat_data['messages']))
+    return chat_data, model, job
+
+def status_line(status):
+    """A JSON status line of the chat stream preamble (sent before the '---' separator)."""
+    return json.dumps({"status": status}) + '\n'
+
+# --- Typed Stream Protocol ---
+# Clients that ask for it (?protocol=ndjson or ?protocol=sse, or the matching Accept header)
+# get one typed event per line instead of the header/'---'/raw text framing:
+#   meta     {"v", "chatId", "jobId", "model", "messageIndex", ["user_message", "userMessageIndex"]}
+#            always first; messageIndex is the index the answer will have in the chat
+#   status   {"message"}                      extraction / queue progress
+#   token    {"text", "offset"}               answer text
+#   search   {"text", "offset", "queries"}    web search notice (also part of the answer text)
+#   sources  {"text", "offset", "sources"}    sources list (also part of the answer text)
+#   usage    {prompt_eval_count, eval_count, *_duration in ns}  as reported by Ollama
+#   timings  {extraction, queue_wait, web_search, time_to_first_token, prompt_eval, eval, load,
+#             tokens_per_second}            seconds per stage of the turn; only with ?timings=1,
+#                                           and only the stages the turn went through
+#   done     {"offset", "cancelled"}          always last
+# "offset" is the answer length after the event, usable with the reattach endpoint.
+# Without a protocol request the original framing is sent unchanged.
+STREAM_PROTOCOLS = {'ndjson': 'application/x-ndjson', 'sse': 'text/event-stream'}
+
+def requested_stream_protocol(args, accept_header):
+    """Returns 'ndjson', 'sse' or None (the original text framing)."""
+    protocol = args.get('protocol')
+    if protocol in STREAM_PROTOCOLS: return protocol
+    for name, mimetype in STREAM_PROTOCOLS.items():
+        if mimetype in (accept_header or ''): return name
+    return None
+
+def requested_offset(args, headers):
+    """
+    The answer offset a reattaching client resumes from: the Last-Event-ID header (sent by SSE
+    clients on reconnect) if present, else ?offset=N, else 0. Raises ChatRequestError if invalid.
+    """
+    value = headers.get('Last-Event-ID')
+    if value is None: value = args.get('offset', '0')
+    try:
+        offset = int(value)
+    except ValueError:
+        raise ChatRequestError(f"Invalid stream offset: {value!r}")
+    if offset < 0: raise ChatRequestError(f"Invalid stream offset: {value!r}")
+    return offset
+
+def requested_timings(args):
+    """Whether the client asked for the timings event (?timings=1) at the end of a typed stream."""
+    return args.get('timings') == '1'
+
+def stream_event(item, offset):
+    """Converts an item of job.follow() to a typed event; `offset` is the answer length after it."""
+    if isinstance(item, StreamStatus): return {"type": "status", "message": str(item)}
+    if isinstance(item, StreamSegment): return {"type": item.kind, "text": str(item), "offset": offset, **item.data}
+    return {"type": "token", "text": item, "offset": offset}
+
+def stream_closing_events(job, offset, timings=False):
+    """The usage, timings and done events that end a typed stream once `job` has finished."""
+    if job.usage: yield {"type": "usage", **job.usage}
+    if timings: yield {"type": "timings", **job.timings}
+    yield {"type": "done", "offset": offset, "cancelled": job.cancelled}
+
+def encode_stream_event(event, protocol):
+    data = json.dumps(event)
+    if protocol == 'sse':
+        event_id = f"id: {event['offset']}\n" if 'offset' in event else ''
+        return f"{event_id}event: {event['type']}\ndata: {data}\n\n"
+    return data + '\n'
+
+def typed_stream(job, protocol, meta, offset=0, timings=False):
+    """Encodes a generation job as typed stream events, starting from answer offset `offset`."""
+    yield encode_stream_event({"type": "meta", "v": STREAM_PROTOCOL_VERSION, **meta}, protocol)
+    for item in job.follow(offset):
+        if not isinstance(item, StreamStatus): offset += len(item)
+        yield encode_stream_event(stream_event(item, offset), protocol)
+    for event in stream_closing_events(job, offset, timings):
+        yield encode_stream_event(event, protocol)
+
+def typed_stream_response(response_class, stream, protocol, job):
+    """Wraps a typed stream in `response_class` (Flask's or Quart's Response)."""
+    return response_class(stream, mimetype=STREAM_PROTOCOLS[protocol], headers={
+        'X-Job-Id': job.id, 'X-Stream-Protocol': f"{protocol}/{STREAM_PROTOCOL_VERSION}", 'Cache-Control': 'no-cache',
+    })
 
 
 # --- API Endpoints ---
@@ -300,36 +2272,94 @@ def index():
 def get_attachment(chat_id, filename):
     if not re.match(r'^[a-zA-Z0-9-]+$', chat_id) or '..' in filename: abort(400)
     directory = CHATS_DIR / chat_id / ATTACHMENTS_DIR_NAME
-    if not directory.is_dir(): abort(404)
-    return send_from_directory(directory, filename)
+    if (directory / filename).is_file(): return send_from_directory(directory, filename) # Legacy per-chat copy
+    sha256 = Path(filename).stem
+    if not re.fullmatch(r'[0-9a-f]{64}', sha256) or not has_attachment_ref(sha256, chat_id): abort(404)
+    return send_file(_blob_path(sha256), mimetype=mimetypes.guess_type(filename)[0])
+
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 @app.route('/api/models', methods=['GET'])
 def get_models():
+    """
+    Chat models (everything but the models Ollama reports as embedding models) with their
+    capabilities, whether they are loaded or pinned, and their median cold and warm load times
+    in seconds. The catalog is cached; ?refresh=1 re-reads it from Ollama.
+    """
     try:
-        response = ollama.list()
-        all_model_objects = response.get('models', [])
-        text_models_as_dicts = []
-        for model_obj in all_model_objects:
-            model_name = model_obj.get('name') or model_obj.get('model')
-            if model_name:
-                is_vision = 'llava' in model_name.lower() or 'vision' in model_name.lower()
-                is_embed = 'embed' in model_name.lower()
-                if not is_vision and not is_embed:
-                    text_models_as_dicts.append({ 'name': model_name })
+        catalog = model_registry.catalog(refresh=request.args.get('refresh') == '1')
+        loaded, pinned = model_registry.loaded_models(), model_registry.pinned()
+        text_models_as_dicts = [
+            {**model, "loaded": model["name"] in loaded, "pinned": model["name"] in pinned, "loadSeconds": model_registry.load_times(model["name"])}
+            for model in catalog
+            if 'embedding' not in model["capabilities"]
+        ]
         return jsonify(text_models_as_dicts)
     except Exception as e:
-        print(f"CRITICAL: Error fetching models from Ollama: {e}")
+        log_event(logging.CRITICAL, 'ollama_unreachable', "Error fetching models from Ollama", error=str(e))
         return jsonify({"error": f"Could not connect to Ollama. Details: {str(e)}"}), 500
 
 @app.route('/api/chats', methods=['GET'])
 def get_all_chats():
-    return jsonify(get_all_chats_from_disk())
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit <= 0: return jsonify({"error": "limit must be a positive integer."}), 400
+    try:
+        chats, next_cursor = list_chats(limit, request.args.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor."}), 400
+    response = jsonify(chats)
+    if next_cursor: response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+@app.route('/api/search', methods=['GET'])
+def search_chats_route():
+    limit = request.args.get('limit', HISTORY_SEARCH_DEFAULT_LIMIT, type=int)
+    if limit is None or limit <= 0: return jsonify({"error": "limit must be a positive integer."}), 400
+    try:
+        return jsonify(search_chats(request.args.get('q', ''), min(limit, HISTORY_SEARCH_MAX_LIMIT)))
+    except sqlite3.Error as e:
+        log_event(logging.ERROR, 'history_search_failed', "Error searching chats", error=str(e))
+        return jsonify({"error": f"Search failed: {e}"}), 500
+
+def light_message(message):
+    """The message without HEAVY_MESSAGE_FIELDS (returned as is when it has none)."""
+    if not any(field in message for field in HEAVY_MESSAGE_FIELDS): return message
+    return {key: value for key, value in message.items() if key not in HEAVY_MESSAGE_FIELDS}
 
 @app.route('/api/chat/<chat_id>', methods=['GET'])
 def get_chat_history_route(chat_id):
-    chat_data = load_chat_history(chat_id)
-    if chat_data is None: abort(404, "Chat not found")
-    return jsonify(chat_data)
+    """
+    Returns the chat with a page of its messages: the `limit` messages before index `before`
+    (default: the newest ones; without limit: all of them). firstIndex is the index of the
+    first returned message and messageCount the length of the whole chat. Heavy fields such as
+    extracted document text are left out unless full=1; see get_message_route.
+    """
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', type=int)
+    if (before is not None and before < 0) or (limit is not None and limit <= 0):
+        return jsonify({"error": "before must be >= 0 and limit a positive integer."}), 400
+    with chat_lock(chat_id): # Serialize while the shared dict might be changing
+        chat_data = load_chat_history(chat_id)
+        if chat_data is None: abort(404, "Chat not found")
+        messages = chat_data['messages']
+        end = len(messages) if before is None else min(before, len(messages))
+        start = 0 if limit is None else max(0, end - limit)
+        page = messages[start:end] if request.args.get('full') == '1' else [light_message(m) for m in messages[start:end]]
+        response = {**chat_data, "messages": page, "firstIndex": start, "messageCount": len(messages)}
+        active_job = get_active_job(chat_id)
+        if active_job: response["activeJobId"] = active_job.id # Lets a reloaded page reattach
+        return jsonify(response)
+
+@app.route('/api/chat/<chat_id>/message/<int:msg_index>', methods=['GET'])
+def get_message_route(chat_id, msg_index):
+    """Returns one message with all its fields, including the heavy ones left out of chat pages."""
+    with chat_lock(chat_id):
+        chat_data = load_chat_history(chat_id)
+        if chat_data is None: return jsonify({"error": "Chat not found."}), 404
+        if not 0 <= msg_index < len(chat_data['messages']): return jsonify({"error": "Invalid message index."}), 400
+        return jsonify(chat_data['messages'][msg_index])
 
 @app.route('/api/chat/stream', defaults={'chat_id': None}, methods=['POST'])
 @app.route('/api/chat/<chat_id>/stream', methods=['POST'])
@@ -338,36 +2368,64 @@ def stream_message(chat_id):
     prompt = request.form.get('prompt', '')
     files = request.files.getlist('files')
 
-    if not model: return Response("Model not provided", status=400)
-    if not prompt and not files: return Response("Cannot start a chat with an empty message.", status=400)
-
-    is_new_chat = not chat_id
-    if is_new_chat:
-        chat_id = str(uuid.uuid4())
-        chat_data = {"title": "New Chat", "messages": []}
-    else:
-        chat_data = load_chat_history(chat_id)
-        if not chat_data: return Response("Chat not found.", status=404)
-
-    attachments_data, extracted_text = process_and_save_files(chat_id, files)
-    
-    user_message = {"role": "user", "content": prompt}
-    if attachments_data: user_message["attachments"] = attachments_data
-    if extracted_text: user_message["extracted_content"] = extracted_text
-    
-    chat_data['messages'].append(user_message)
-    save_chat_history(chat_id, chat_data)
+    try:
+        chat_id, chat_data, user_message, saved_files, job = begin_user_turn(chat_id, model, prompt, files)
+    except ChatRequestError as e:
+        return Response(str(e), status=e.status, headers=e.headers)
+    user_message_index = job.message_index - 1
+    start_generation_job(job, _chat_turn_generator(chat_id, chat_data, model, user_message_index, saved_files))
+    protocol = requested_stream_protocol(request.args, request.headers.get('Accept'))
+    if protocol:
+        meta = {
+            "chatId": chat_id, "jobId": job.id, "model": model, "messageIndex": user_message_index + 1,
+            "user_message": user_message, "userMessageIndex": user_message_index,
+        }
+        return typed_stream_response(Response, typed_stream(job, protocol, meta, timings=requested_timings(request.args)), protocol, job)
 
     def full_stream():
         # Part 1: Yield initial metadata for the frontend to render the user message instantly
-        initial_data = {"chatId": chat_id, "user_message": user_message}
-        yield json.dumps(initial_data) + '\n---\n'
-        
-        # Part 2: Yield the AI's response stream
-        for chunk in _stream_response_generator(chat_id, chat_data, model):
+        initial_data = {"chatId": chat_id, "jobId": job.id, "user_message": user_message}
+        yield json.dumps(initial_data) + '\n'
+
+        # Part 2: Follow the generation job. Status updates (document extraction, queue position)
+        # that arrive before the first answer text are sent as JSON status lines, then the '---'
+        # separator, then the answer text. Disconnecting only stops following; the job goes on.
+        separator_sent = False
+        for chunk in job.follow():
+            if isinstance(chunk, StreamStatus):
+                if not separator_sent: yield status_line(chunk)
+                continue
+            if not separator_sent:
+                yield '---\n'
+                separator_sent = True
             yield chunk
+        if not separator_sent: yield '---\n'
+
+    return Response(full_stream(), mimetype='text/plain', headers={'X-Job-Id': job.id})
 
-    return Response(full_stream(), mimetype='text/plain')
+@app.route('/api/chat/<chat_id>/stream/<job_id>', methods=['GET'])
+def reattach_stream(chat_id, job_id):
+    """Replays a generation job's answer text from ?offset=N and follows it until it finishes."""
+    job = get_generation_job(chat_id, job_id)
+    if job is None: return jsonify({"error": "Generation job not found."}), 404
+    try:
+        offset = requested_offset(request.args, request.headers)
+        job.snapshot(offset)
+    except ChatRequestError as e:
+        return jsonify(e.to_dict()), e.status
+    except JobOffsetExpired as e:
+        return jsonify({"error": str(e)}), 410
+    protocol = requested_stream_protocol(request.args, request.headers.get('Accept'))
+    if protocol:
+        return typed_stream_response(Response, typed_stream(job, protocol, {"chatId": chat_id, "jobId": job.id}, offset, requested_timings(request.args)), protocol, job)
+    return Response(_answer_text_only(job.follow(offset)), mimetype='text/plain', headers={'X-Job-Id': job.id})
+
+@app.route('/api/chat/<chat_id>/stream/<job_id>/cancel', methods=['POST'])
+def cancel_stream(chat_id, job_id):
+    job = get_generation_job(chat_id, job_id)
+    if job is None: return jsonify({"error": "Generation job not found."}), 404
+    job.cancel()
+    return jsonify({"success": True})
 
 @app.route('/api/chat/<chat_id>/generate_title', methods=['POST'])
 def generate_title_for_chat_route(chat_id):
@@ -385,75 +2443,77 @@ def generate_title_for_chat_route(chat_id):
             
     if not first_user_prompt: return jsonify({"title": "Untitled Chat"})
 
-    new_title = generate_chat_title(first_user_prompt)
-    chat_data['title'] = new_title
-    save_chat_history(chat_id, chat_data)
+    new_title = generate_chat_title(first_user_prompt) # Slow (LLM call), so not under the chat lock
+    with chat_lock(chat_id):
+        chat_data = load_chat_history(chat_id)
+        if chat_data is None: return jsonify({"error": "Chat not found."}), 404
+        update_chat_history(chat_id, chat_data, {"op": "title", "title": new_title})
     return jsonify({"chatId": chat_id, "newTitle": new_title})
         
 @app.route('/api/chat/<chat_id>/message/<int:msg_index>', methods=['DELETE'])
 def delete_message(chat_id, msg_index):
-    chat_data = load_chat_history(chat_id)
-    if not chat_data: return jsonify({"error": "Chat not found."}), 404
-    if not 0 <= msg_index < len(chat_data['messages']): return jsonify({"error": "Invalid message index."}), 400
-    
-    message_to_delete = chat_data['messages'][msg_index]
-    if message_to_delete['role'] == 'user' and msg_index + 1 < len(chat_data['messages']) and chat_data['messages'][msg_index + 1]['role'] == 'assistant':
-        chat_data['messages'].pop(msg_index + 1) # Delete assistant's reply
-    
-    chat_data['messages'].pop(msg_index) # Delete the target message
-            
-    save_chat_history(chat_id, chat_data)
-    return jsonify({"success": True, "remaining_messages": chat_data['messages']})
+    with chat_lock(chat_id):
+        chat_data = load_chat_history(chat_id)
+        if not chat_data: return jsonify({"error": "Chat not found."}), 404
+        if not 0 <= msg_index < len(chat_data['messages']): return jsonify({"error": "Invalid message index."}), 400
+        try:
+            ensure_no_active_job(chat_id)
+        except ChatRequestError as e:
+            return jsonify(e.to_dict()), e.status, e.headers
+        
+        message_to_delete = chat_data['messages'][msg_index]
+        delete_count = 1 # The target message
+        if message_to_delete['role'] == 'user' and msg_index + 1 < len(chat_data['messages']) and chat_data['messages'][msg_index + 1]['role'] == 'assistant':
+            delete_count = 2 # Also delete the assistant's reply
+                
+        update_chat_history(chat_id, chat_data, {"op": "delete", "index": msg_index, "count": delete_count})
+        # A diff instead of the remaining messages: later messages move up by `count`
+        return jsonify({"success": True, "deleted": {"index": msg_index, "count": delete_count}, "messageCount": len(chat_data['messages'])})
 
 @app.route('/api/chat/<chat_id>/regenerate', methods=['POST'])
 def regenerate_response(chat_id):
-    data = request.json
-    model = data.get('model')
-    msg_index = data.get('msg_index')
-
-    if not model or msg_index is None: return Response("Model and message index not provided.", status=400)
-    chat_data = load_chat_history(chat_id)
-    if not chat_data: return Response("Chat not found", status=404)
-    if not (0 <= msg_index < len(chat_data['messages']) and chat_data['messages'][msg_index]['role'] == 'assistant'):
-        return Response("Invalid index for regeneration.", status=400)
-    
-    # Prune the conversation to the point *before* the message to be regenerated
-    chat_data['messages'] = chat_data['messages'][:msg_index]
-    save_chat_history(chat_id, chat_data)
+    try:
+        chat_data, model, job = begin_regeneration(chat_id, request.json)
+    except ChatRequestError as e:
+        return Response(str(e), status=e.status, headers=e.headers)
     
-    # The response stream will automatically save the new message upon completion/interruption
-    return Response(_stream_response_generator(chat_id, chat_data, model), mimetype='text/plain')
+    # The generation job will automatically save the new message upon completion/cancellation
+    start_generation_job(job, _stream_response_generator(chat_id, chat_data, model, job.message_index))
+    protocol = requested_stream_protocol(request.args, request.headers.get('Accept'))
+    if protocol:
+        return typed_stream_response(Response, typed_stream(job, protocol, {"chatId": chat_id, "jobId": job.id, "model": model, "messageIndex": job.message_index}, timings=requested_timings(request.args)), protocol, job)
+    return Response(_answer_text_only(job.follow()), mimetype='text/plain', headers={'X-Job-Id': job.id})
 
 @app.route('/api/chat/<chat_id>/edit_and_regenerate', methods=['POST'])
 def edit_and_regenerate(chat_id):
-    data = request.json
-    model, msg_index, new_prompt = data.get('model'), data.get('msg_index'), data.get('new_prompt')
-
-    if not all([model, isinstance(msg_index, int), new_prompt is not None]): return jsonify({"error": "Missing required data."}), 400
-    
-    chat_data = load_chat_history(chat_id)
-    if not chat_data: return jsonify({"error": "Chat not found"}), 404
-    if not (0 <= msg_index < len(chat_data['messages']) and chat_data['messages'][msg_index]['role'] == 'user'):
-        return jsonify({"error": "Invalid index for edit."}), 400
-
-    # Update the user message and prune the history to that point
-    chat_data['messages'][msg_index]['content'] = new_prompt
-    chat_data['messages'] = chat_data['messages'][:msg_index + 1]
-    save_chat_history(chat_id, chat_data)
+    try:
+        chat_data, model, job = begin_edit(chat_id, request.json)
+    except ChatRequestError as e:
+        return jsonify(e.to_dict()), e.status, e.headers
     
     # Call the main streamer to get a new response
-    # This automatically supports web search and interruptions for the edited prompt
-    return Response(_stream_response_generator(chat_id, chat_data, model), mimetype='text/plain')
+    # This automatically supports web search and cancellation for the edited prompt
+    start_generation_job(job, _stream_response_generator(chat_id, chat_data, model, job.message_index))
+    protocol = requested_stream_protocol(request.args, request.headers.get('Accept'))
+    if protocol:
+        return typed_stream_response(Response, typed_stream(job, protocol, {"chatId": chat_id, "jobId": job.id, "model": model, "messageIndex": job.message_index}, timings=requested_timings(request.args)), protocol, job)
+    return Response(_answer_text_only(job.follow()), mimetype='text/plain', headers={'X-Job-Id': job.id})
 
 @app.route('/api/chat/<chat_id>', methods=['DELETE'])
 def delete_chat(chat_id):
     chat_folder = CHATS_DIR / chat_id
-    if chat_folder.is_dir():
-        try:
-            shutil.rmtree(chat_folder)
-            return jsonify({"success": True})
-        except OSError as e:
-            return jsonify({"error": f"Error deleting chat folder: {e}"}), 500
+    with chat_lock(chat_id):
+        active_job = get_active_job(chat_id)
+        if active_job: active_job.cancel() # Its answer is discarded once the chat is gone
+        if chat_folder.is_dir():
+            try:
+                shutil.rmtree(chat_folder)
+                forget_chat(chat_id)
+                unindex_chat(chat_id)
+                release_chat_attachments(chat_id)
+                return jsonify({"success": True})
+            except OSError as e:
+                return jsonify({"error": f"Error deleting chat folder: {e}"}), 500
     return jsonify({"error": "Chat not found"}), 404
 
 if __name__ == '__main__':
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# --- Async (ASGI) Server Entry Point ---
+# Serves the same application as app.py, but the streaming endpoints run as coroutines on
+# ollama.AsyncClient under an ASGI server, so hundreds of idle-waiting streams cost coroutines
+# rather than worker threads. All other endpoints are delegated unchanged to the Flask app,
+# each request on its own worker thread (FLASK_WORKER_THREADS), so a slow Flask request never
+# holds up the others. Chat logic (prompt assembly, tool detection, history updates) is shared
+# with app.py; only the network-bound loop is reimplemented here. Answers run as detached
+# generation jobs, exactly like in app.py; reattaching and cancelling are served here as well.
+#
+# Run with:  python asgi.py   or   hypercorn asgi:application --bind 0.0.0.0:5005
+
+import asyncio
+import json
+import logging
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ollama
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from quart import Quart, request, jsonify, Response
+
+from app import (
+    app as flask_app, inference_scheduler, model_registry, run_web_searches, extract_attachment_texts,
+    prepare_chat_turn, SearchTagDetector, parse_search_queries, format_search_results,
+    format_sources_markdown, queue_status, save_assistant_response, status_line,
+    begin_user_turn, begin_regeneration, begin_edit, store_extracted_text,
+    finish_generation_job, get_generation_job, JobOffsetExpired, ChatRequestError, StreamStatus, StreamSegment, StreamUsage,
+    StreamTimings, add_usage, record_ollama_usage, record_first_token, log_event,
+    requested_stream_protocol, requested_offset, requested_timings, stream_event, stream_closing_events, encode_stream_event, typed_stream_response,
+    PRIORITY_INTERACTIVE, SCHEDULER_STATUS_INTERVAL, MAX_TOOL_ROUNDS,
+    STREAM_PROTOCOL_VERSION, STREAM_BATCH_INTERVAL, STREAM_BATCH_CHARS,
+)
+
+# Endpoints that start or follow generations are served by the async app; everything else goes to Flask.
+ASYNC_ROUTES = re.compile(r'/api/chat(/[^/]+)?/stream|/api/chat/[^/]+/(regenerate|edit_and_regenerate|stream/[^/]+(/cancel)?)')
+FLASK_WORKER_THREADS = 32 # Flask requests handled at the same time under the ASGI server
+
+async_app = Quart(__name__)
+# Quart limits request bodies to 16 MB / 60 s and responses to 60 s by default; the Flask server
+# has no such limits, and large uploads and long answers must work the same under both.
+async_app.config.update(MAX_CONTENT_LENGTH=flask_app.config['MAX_CONTENT_LENGTH'], BODY_TIMEOUT=None, RESPONSE_TIMEOUT=None)
+ollama_client = ollama.AsyncClient()
+
+def _threadsafe_event():
+    """Returns (event, wake): an asyncio.Event of the running loop and a callback that sets it from any thread."""
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    def wake():
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass # The loop is closed, nobody is waiting anymore
+    return event, wake
+
+async def _wait_for_slot(ticket, granted, timeout):
+    """
+    Waits for a scheduler ticket without blocking a thread; `granted` is an event registered
+    with ticket.on_granted(). Returns True once the slot is granted.
+    """
+    try:
+        await asyncio.wait_for(granted.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        ticket.scheduler.dispatch() # Re-evaluate, e.g. this ticket may now have waited long enough
+        return ticket.granted.is_set()
+
+async def _next_or_none(iterator):
+    """Advances a blocking iterator in a worker thread; returns (True, value) or (False, return value)."""
+    def step():
+        try:
+            return True, next(iterator)
+        except StopIteration as done:
+            return False, done.value
+    return await asyncio.to_thread(step)
+
+async def _stream_response_agenerator(chat_id, chat_data, model, message_index):
+    """Async counterpart of app._stream_response_generator, yielding the same items."""
+    full_response_content = ""
+    final_model = model
+    sources_used = []
+    usage = StreamUsage()
+    timings = StreamTimings()
+    started = time.monotonic()
+    ticket = None
+    stream = None
+
+    try:
+        final_model, messages_for_api, llm_options = await asyncio.to_thread(prepare_chat_turn, chat_id, chat_data, model)
+
+        # Wait for an inference slot, reporting the queue position while waiting
+        ticket = inference_scheduler.submit(final_model, PRIORITY_INTERACTIVE)
+        granted, wake = _threadsafe_event()
+        ticket.on_granted(wake)
+        while not await _wait_for_slot(ticket, granted, SCHEDULER_STATUS_INTERVAL):
+            yield queue_status(ticket)
+        timings["queue_wait"] = ticket.granted_at - ticket.enqueued_at
+
+        # Main loop for tool use (e.g., search -> answer)
+        for _ in range(MAX_TOOL_ROUNDS):
+            stream = await ollama_client.chat(model=final_model, messages=messages_for_api, stream=True, options=llm_options, keep_alive=model_registry.keep_alive(final_model))
+            detector = SearchTagDetector()
+            async for chunk in stream:
+                forward = detector.feed(chunk['message'].get('content') or '')
+                if forward:
+                    if "time_to_first_token" not in timings: record_first_token(timings, final_model, started)
+                    full_response_content += forward
+                    yield forward
+                if chunk.get('done'): add_usage(usage, chunk)
+                if detector.tool_call_complete: break
+            await stream.aclose()
+            search_match = detector.search_match()
+
+            if not search_match: # No tool use, this is the final answer
+                if detector.pending:
+                    full_response_content += detector.pending
+                    yield detector.pending
+                if sources_used:
+                    sources_markdown = format_sources_markdown(sources_used)
+                    full_response_content += sources_markdown
+                    yield StreamSegment(sources_markdown, 'sources', sources=sources_used)
+                if usage:
+                    timings.update(record_ollama_usage(final_model, usage))
+                    yield usage
+                yield timings
+                return
+
+            # Tool use detected (Web Search)
+            try:
+                search_queries = parse_search_queries(search_match)
+                log_event(logging.INFO, 'web_search_requested', "Model requested web search", chat_id=chat_id, queries=search_queries)
+                search_status_msg = f"Searching the web for: {', '.join(f'`{q}`' for q in search_queries)}\n\n"
+                full_response_content += search_status_msg
+                yield StreamSegment(search_status_msg, 'search', queries=search_queries)
+
+                search_started = time.monotonic()
+                outcomes = await asyncio.to_thread(run_web_searches, search_queries)
+                timings["web_search"] = timings.get("web_search", 0) + time.monotonic() - search_started
+                results_text = format_search_results(outcomes, sources_used)
+                messages_for_api.append({'role': 'assistant', 'content': detector.pending.strip()})
+                messages_for_api.append({'role': 'user', 'content': results_text})
+            except Exception as e:
+                log_event(logging.ERROR, 'web_search_failed', "Error during search tool use", chat_id=chat_id, error=str(e))
+                error_msg = f"An error occurred while trying to perform a web search: {e}"
+                full_response_content += error_msg
+                yield error_msg
+                return
+
+    except GeneratorExit:
+        log_event(logging.INFO, 'generation_stopped', "Generation was stopped before it finished", chat_id=chat_id)
+    except asyncio.CancelledError:
+        log_event(logging.INFO, 'generation_stopped', "Generation was stopped before it finished", chat_id=chat_id)
+        raise
+    except Exception as e:
+        log_event(logging.ERROR, 'generation_error', "Unexpected error while generating an answer", exc_info=True, chat_id=chat_id)
+        yield f"An unexpected error occurred: {str(e)}"
+    finally:
+        # Closing the Ollama stream drops its connection, which makes Ollama stop generating.
+        if stream is not None:
+            try:
+                await stream.aclose()
+            except Exception:
+                pass
+        if ticket is not None: ticket.release()
+        # Save final or partial answers, exactly like the threaded server does.
+        if full_response_content:
+            await asyncio.to_thread(save_assistant_response, chat_id, full_response_content, final_model, message_index)
+
+async def _chat_turn_agenerator(chat_id, chat_data, model, user_message_index, saved_files):
+    """Async counterpart of app._chat_turn_generator: extraction progress, then the answer."""
+    if saved_files:
+        started = time.monotonic()
+        extraction = extract_attachment_texts(chat_id, saved_files)
+        while True:
+            has_status, value = await _next_or_none(extraction)
+            if not has_status: break
+            yield StreamStatus(value)
+        await asyncio.to_thread(store_extracted_text, chat_id, chat_data, user_message_index, value)
+        yield StreamTimings(extraction=time.monotonic() - started)
+    async for item in _stream_response_agenerator(chat_id, chat_data, model, user_message_index + 1):
+        yield item
+
+# --- Detached Generation Jobs (asyncio tasks) ---
+# Jobs are the same GenerationJob objects as in app.py, so the Flask reattach and cancel
+# endpoints work for them too; only the producer runs as a task instead of a thread.
+_job_tasks = set() # Strong references so running tasks are not garbage-collected
+
+async def _run_generation_job(job, source):
+    outcome = 'completed'
+    try:
+        async for item in source:
+            if job.cancelled: break
+            if isinstance(item, StreamStatus): job.set_status(item)
+            elif isinstance(item, StreamUsage): job.set_usage(item)
+            elif isinstance(item, StreamTimings): job.add_timings(item)
+            else: job.append(item)
+    except Exception as e:
+        outcome = 'failed'
+        log_event(logging.ERROR, 'generation_job_failed', "Generation job failed", exc_info=True, job_id=job.id, chat_id=job.chat_id)
+    finally:
+        await source.aclose() # On cancel this saves the partial answer and stops Ollama
+        job.finish()
+        finish_generation_job(job, outcome)
+
+def start_generation_job(job, source):
+    task = asyncio.get_running_loop().create_task(_run_generation_job(job, source))
+    _job_tasks.add(task)
+    task.add_done_callback(_job_tasks.discard)
+    return job
+
+async def follow_job(job, offset=0):
+    """Async counterpart of GenerationJob.follow(), woken by the job instead of blocking a thread."""
+    loop = asyncio.get_running_loop()
+    changed, wake = _threadsafe_event()
+    job.add_listener(wake)
+    try:
+        version, last_status, batch_deadline = -1, None, None
+        while True:
+            changed.clear() # Before the snapshot, so a change made after it is not missed
+            new_version, pieces, status, done = job.snapshot(offset)
+            if new_version == version:
+                await changed.wait()
+                continue
+            if pieces and not done and not job.cancelled and job.length - offset < STREAM_BATCH_CHARS:
+                # Coalesce answer text like GenerationJob.follow() does
+                if batch_deadline is None: batch_deadline = loop.time() + STREAM_BATCH_INTERVAL
+                remaining = batch_deadline - loop.time()
+                if remaining > 0:
+                    try:
+                        await asyncio.wait_for(changed.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+            version, batch_deadline = new_version, None
+            if status and status != last_status:
+                last_status = status
+                yield StreamStatus(status)
+            for piece in pieces:
+                offset += len(piece)
+                yield piece
+            if done: return
+    finally:
+        job.remove_listener(wake)
+
+async def typed_stream(job, protocol, meta, offset=0, timings=False):
+    """Async counterpart of app.typed_stream."""
+    yield encode_stream_event({"type": "meta", "v": STREAM_PROTOCOL_VERSION, **meta}, protocol)
+    async for item in follow_job(job, offset):
+        if not isinstance(item, StreamStatus): offset += len(item)
+        yield encode_stream_event(stream_event(item, offset), protocol)
+    for event in stream_closing_events(job, offset, timings):
+        yield encode_stream_event(event, protocol)
+
+async def _answer_text_only(agenerator):
+    async for chunk in agenerator:
+        if not isinstance(chunk, StreamStatus): yield chunk
+
+# --- Async API Endpoints (same paths and stream format as app.py) ---
+@async_app.route('/api/chat/stream', defaults={'chat_id': None}, methods=['POST'])
+@async_app.route('/api/chat/<chat_id>/stream', methods=['POST'])
+async def stream_message(chat_id):
+    form = await request.form
+    files = (await request.files).getlist('files')
+    try:
+        chat_id, chat_data, user_message, saved_files, job = await asyncio.to_thread(
+            begin_user_turn, chat_id, form.get('model'), form.get('prompt', ''), files
+        )
+    except ChatRequestError as e:
+        return Response(str(e), status=e.status, headers=e.headers)
+    model = form.get('model')
+    user_message_index = job.message_index - 1
+    start_generation_job(job, _chat_turn_agenerator(chat_id, chat_data, model, user_message_index, saved_files))
+    protocol = requested_stream_protocol(request.args, request.headers.get('Accept'))
+    if protocol:
+        meta = {
+            "chatId": chat_id, "jobId": job.id, "model": model, "messageIndex": user_message_index + 1,
+            "user_message": user_message, "userMessageIndex": user_message_index,
+        }
+        return typed_stream_response(Response, typed_stream(job, protocol, meta, timings=requested_timings(request.args)), protocol, job)
+
+    async def full_stream():
+        yield json.dumps({"chatId": chat_id, "jobId": job.id, "user_message": user_message}) + '\n'
+        separator_sent = False
+        async for chunk in follow_job(job):
+            if isinstance(chunk, StreamStatus):
+                if not separator_sent: yield status_line(chunk)
+                continue
+            if not separator_sent:
+                yield '---\n'
+                separator_sent = True
+            yield chunk
+        if not separator_sent: yield '---\n'
+
+    return Response(full_stream(), mimetype='text/plain', headers={'X-Job-Id': job.id})
+
+@async_app.route('/api/chat/<chat_id>/regenerate', methods=['POST'])
+async def regenerate_response(chat_id):
+    try:
+        chat_data, model, job = await asyncio.to_thread(begin_regeneration, chat_id, await request.get_json())
+    except ChatRequestError as e:
+        return Response(str(e), status=e.status, headers=e.headers)
+    start_generation_job(job, _stream_response_agenerator(chat_id, chat_data, model, job.message_index))
+    protocol = requested_stream_protocol(request.args, request.headers.get('Accept'))
+    if protocol:
+        return typed_stream_response(Response, typed_stream(job, protocol, {"chatId": chat_id, "jobId": job.id, "model": model, "messageIndex": job.message_index}, timings=requested_timings(request.args)), protocol, job)
+    return Response(_answer_text_only(follow_job(job)), mimetype='text/plain', headers={'X-Job-Id': job.id})
+
+@async_app.route('/api/chat/<chat_id>/edit_and_regenerate', methods=['POST'])
+async def edit_and_regenerate(chat_id):
+    try:
+        chat_data, model, job = await asyncio.to_thread(begin_edit, chat_id, await request.get_json())
+    except ChatRequestError as e:
+        return jsonify(e.to_dict()), e.status, e.headers
+    start_generation_job(job, _stream_response_agenerator(chat_id, chat_data, model, job.message_index))
+    protocol = requested_stream_protocol(request.args, request.headers.get('Accept'))
+    if protocol:
+        return typed_stream_response(Response, typed_stream(job, protocol, {"chatId": chat_id, "jobId": job.id, "model": model, "messageIndex": job.message_index}, timings=requested_timings(request.args)), protocol, job)
+    return Response(_answer_text_only(follow_job(job)), mimetype='text/plain', headers={'X-Job-Id': job.id})
+
+@async_app.route('/api/chat/<chat_id>/stream/<job_id>', methods=['GET'])
+async def reattach_stream(chat_id, job_id):
+    """Async counterpart of app.reattach_stream."""
+    job = get_generation_job(chat_id, job_id)
+    if job is None: return jsonify({"error": "Generation job not found."}), 404
+    try:
+        offset = requested_offset(request.args, request.headers)
+        job.snapshot(offset)
+    except ChatRequestError as e:
+        return jsonify(e.to_dict()), e.status
+    except JobOffsetExpired as e:
+        return jsonify({"error": str(e)}), 410
+    protocol = requested_stream_protocol(request.args, request.headers.get('Accept'))
+    if protocol:
+        return typed_stream_response(Response, typed_stream(job, protocol, {"chatId": chat_id, "jobId": job.id}, offset, requested_timings(request.args)), protocol, job)
+    return Response(_answer_text_only(follow_job(job, offset)), mimetype='text/plain', headers={'X-Job-Id': job.id})
+
+@async_app.route('/api/chat/<chat_id>/stream/<job_id>/cancel', methods=['POST'])
+async def cancel_stream(chat_id, job_id):
+    job = get_generation_job(chat_id, job_id)
+    if job is None: return jsonify({"error": "Generation job not found."}), 404
+    job.cancel()
+    return jsonify({"success": True})
+
+# asgiref runs WSGI apps thread-sensitively, i.e. every request on one shared thread, which
+# would serialize the whole Flask side. Run each request on a worker of a pool instead.
+_flask_executor = ThreadPoolExecutor(max_workers=FLASK_WORKER_THREADS, thread_name_prefix='flask')
+_run_wsgi_app = WsgiToAsgiInstance.__dict__['run_wsgi_app'].func # The undecorated method
+
+class _ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    async def run_wsgi_app(self, body):
+        await sync_to_async(_run_wsgi_app, thread_sensitive=False, executor=_flask_executor)(self, body)
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await _ThreadPoolWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+flask_asgi = ThreadPoolWsgiToAsgi(flask_app)
+
+async def application(scope, receive, send):
+    """ASGI entry point: streaming endpoints run natively, everything else goes to Flask."""
+    if scope['type'] != 'http' or ASYNC_ROUTES.fullmatch(scope['path']):
+        await async_app(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
+
+if __name__ == '__main__':
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = ['0.0.0.0:5005']
+    asyncio.run(serve(application, config))
@@ -0,0 +1,640 @@
+#!/usr/bin/env python3
+# --- Benchmark and Load-Test Suite ---
+# Starts the Flask app against a local stub Ollama server and a stub web search provider, replays
+# a set of workloads against it over HTTP and reports latency percentiles, time to first token
+# (TTFT), throughput and server memory (RSS). Results can be stored as a baseline JSON file and
+# later runs compared against it, so regressions show up as numbers instead of impressions.
+#
+# Everything runs in a throwaway working directory (chats/, cache/, attachment_store/ are
+# created there), so your own chats are never touched. The stubs are deterministic: answers,
+# uploads and seeded chats only depend on --seed and the workload options.
+#
+# Run from the same directory as app.py:
+#   python benchmark.py run                                # all scenarios, report to bench_output.txt
+#   python benchmark.py run --quick                        # small smoke run
+#   python benchmark.py run --save-baseline bench_baseline.json
+#   python benchmark.py run --baseline bench_baseline.json # exits with 1 on regressions
+#   python benchmark.py stub-ollama --port 11434           # just the fake Ollama, e.g. for manual testing
+
+import argparse
+import hashlib
+import http.client
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+
+# --- Configuration ---
+REPO_DIR = Path(__file__).resolve().parent
+BENCH_HOST = '127.0.0.1'
+BENCH_MODEL = 'bench-model:latest'
+STUB_MODELS = [BENCH_MODEL, 'llava:latest', 'gemma3:1b'] # Reported by the stub's /api/tags
+SEARCH_TRIGGER = '[bench:search]' # A prompt ending in this makes the stub answer with a <search> tag
+LONG_CHAT_ID = 'bench-long-chat'
+SERVER_START_TIMEOUT = 120 # Seconds to wait for the app (including seeding) to come up
+REQUEST_TIMEOUT = 300 # Seconds per HTTP request of a workload
+RSS_SAMPLE_INTERVAL = 0.1 # Seconds between samples of the server's memory use
+DEFAULT_TOLERANCE = 0.15 # Relative change that counts as a regression against the baseline
+DEFAULT_REPORT_FILE = REPO_DIR / 'bench_output.txt'
+SCENARIOS = ('chat_list', 'long_chat', 'uploads', 'streaming')
+WORDS = ("model server token stream chat answer search cache index latency memory request upload "
+         "document window context prompt history title python flask ollama vision image page").split()
+
+# --- Stub Ollama Server ---
+# Speaks the parts of the Ollama HTTP API the app uses (/api/tags, /api/show, /api/ps and
+# /api/chat, streaming and not). The first request for a model pays a cold load; answers are then
+# generated at a fixed rate after a fixed delay, and a user message ending in SEARCH_TRIGGER is
+# answered with a <search> tool call so the web search path can be measured.
+class StubOllamaHandler(BaseHTTPRequestHandler):
+    server_version = 'StubOllama/1'
+
+    def log_message(self, format, *args):
+        pass # Keep the benchmark output readable
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/api/tags':
+            self._send_json({"models": [
+                {"name": name, "model": name, "size": 0, "digest": hashlib.sha256(name.encode('utf-8')).hexdigest()} for name in STUB_MODELS
+            ]})
+        elif self.path == '/api/ps':
+            with self.server.lock: loaded = sorted(self.server.loaded)
+            self._send_json({"models": [{"name": name, "model": name, "size": 0} for name in loaded]})
+        elif self.path == '/api/version':
+            self._send_json({"version": "0.0.0-stub"})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        if self.path == '/api/chat':
+            self._chat(body)
+        elif self.path == '/api/show':
+            name = body.get('model') or body.get('name') or ''
+            if name not in STUB_MODELS: return self._send_json({"error": f"model '{name}' not found"}, 404)
+            vision = 'llava' in name
+            self._send_json({
+                "capabilities": ["completion", "vision"] if vision else ["completion"],
+                "details": {"family": "llama", "families": ["llama", "clip"] if vision else ["llama"]},
+                "model_info": {"general.architecture": "llama", "llama.context_length": 8192},
+                "modelfile": "", "parameters": "", "template": "",
+            })
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _answer_pieces(self, body):
+        config = self.server.config
+        messages = body.get('messages') or []
+        last = messages[-1].get('content', '') if messages else ''
+        if last.rstrip().endswith(SEARCH_TRIGGER):
+            query = "benchmark " + hashlib.sha1(last.encode('utf-8')).hexdigest()[:8] # Unique per prompt: a cache miss
+            return ["<search>\n", json.dumps({"query": query}), "\n</search>"]
+        count = min(config.answer_tokens, (body.get('options') or {}).get('num_predict') or config.answer_tokens)
+        return [WORDS[i % len(WORDS)] + " " for i in range(count)]
+
+    def _load(self, model):
+        """Simulates loading `model` into memory; returns the load seconds (short once it is loaded)."""
+        started = time.monotonic()
+        with self.server.lock:
+            cold = model not in self.server.loaded
+            self.server.loaded.add(model)
+        time.sleep(self.server.config.load_latency if cold else 0.001)
+        return time.monotonic() - started
+
+    def _chat(self, body):
+        config = self.server.config
+        load = self._load(body.get('model'))
+        final = {
+            "model": body.get('model'), "created_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "stop", "load_duration": int(load * 1e9),
+        }
+        if not body.get('messages'): # A request without messages only loads the model
+            final["done_reason"] = "load"
+            return self._send_json(final) if not body.get('stream', True) else self._stream([], final)
+        pieces = self._answer_pieces(body)
+        prompt_chars = sum(len(m.get('content') or '') for m in body.get('messages') or [])
+        started = time.monotonic()
+        time.sleep(config.latency) # Prompt evaluation
+        prompt_eval = time.monotonic() - started
+        final.update(prompt_eval_count=prompt_chars // 4, prompt_eval_duration=int(prompt_eval * 1e9))
+        if not body.get('stream', True):
+            time.sleep(len(pieces) / config.tokens_per_second)
+            final["message"]["content"] = "".join(pieces)
+            final.update(eval_count=len(pieces), eval_duration=int((time.monotonic() - started - prompt_eval) * 1e9))
+            final["total_duration"] = int((time.monotonic() - started) * 1e9)
+            self._send_json(final)
+            return
+        self._stream(pieces, final, started, prompt_eval)
+
+    def _stream(self, pieces, final, started=None, prompt_eval=0):
+        config = self.server.config
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers() # No Content-Length: the stream ends when the connection closes
+        started = started or time.monotonic()
+        try:
+            for piece in pieces:
+                time.sleep(1 / config.tokens_per_second)
+                chunk = {"model": final["model"], "created_at": final["created_at"], "message": {"role": "assistant", "content": piece}, "done": False}
+                self.wfile.write(json.dumps(chunk).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            final.update(eval_count=len(pieces), eval_duration=int((time.monotonic() - started - prompt_eval) * 1e9))
+            final["total_duration"] = int((time.monotonic() - started) * 1e9)
+            self.wfile.write(json.dumps(final).encode('utf-8') + b'\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass # The app closed the stream (cancel or finished tool call)
+
+class StubOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, tokens_per_second, latency, answer_tokens, load_latency):
+        super().__init__((BENCH_HOST, port), StubOllamaHandler)
+        self.config = argparse.Namespace(tokens_per_second=tokens_per_second, latency=latency, answer_tokens=answer_tokens, load_latency=load_latency)
+        self.loaded = set() # Models "in memory"
+        self.lock = threading.Lock()
+
+# --- Stub Web Search ---
+class StubSearchBackend:
+    """Search backend (see app.set_search_backend) returning canned results after `latency` seconds."""
+    def __init__(self, latency):
+        self.latency = latency
+
+    def search(self, query, max_results):
+        time.sleep(self.latency)
+        return [
+            {"title": f"Result {i + 1} for {query}", "href": f"https://example.invalid/{i + 1}?q={query.replace(' ', '+')}",
+             "body": f"Snippet {i + 1} about {query}. " + " ".join(WORDS[:12])}
+            for i in range(max_results)
+        ]
+
+# --- Seeding and Generated Uploads ---
+def _sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+def seed_chats(chat_app, chat_count, long_messages, rng):
+    """Creates `chat_count` short chats and one chat with `long_messages` messages (LONG_CHAT_ID)."""
+    for i in range(chat_count):
+        messages = []
+        for _ in range(rng.randint(1, 3)):
+            messages.append({"role": "user", "content": _sentence(rng)})
+            messages.append({"role": "assistant", "content": " ".join(_sentence(rng) for _ in range(4)), "model": BENCH_MODEL})
+        chat_app.save_chat_history(f"bench-{i:06d}", {"title": _sentence(rng, 4)[:-1], "messages": messages})
+    if long_messages:
+        messages = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": " ".join(_sentence(rng) for _ in range(3))}
+            for i in range(long_messages)
+        ]
+        chat_app.save_chat_history(LONG_CHAT_ID, {"title": "Long benchmark conversation", "messages": messages})
+
+def make_pdf(pages, variant):
+    import fitz
+    document = fitz.open()
+    rng = random.Random(f"pdf-{variant}")
+    for page_number in range(pages):
+        page = document.new_page()
+        text = "\n".join(_sentence(rng) for _ in range(30))
+        page.insert_textbox(fitz.Rect(40, 40, 570, 810), f"Page {page_number + 1} ({variant})\n{text}", fontsize=8)
+    return document.tobytes()
+
+def make_docx(pages, variant):
+    import docx
+    document = docx.Document()
+    rng = random.Random(f"docx-{variant}")
+    for page_number in range(pages):
+        document.add_heading(f"Section {page_number + 1} ({variant})", level=2)
+        for _ in range(8): document.add_paragraph(" ".join(_sentence(rng) for _ in range(5)))
+    buffer = BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+def make_heic(side, variant):
+    from PIL import Image
+    import pillow_heif
+    rng = random.Random(f"heic-{variant}")
+    image = Image.effect_noise((side, side), 64).convert('RGB')
+    image.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (0, 0, side // 4, side // 4))
+    buffer = BytesIO()
+    pillow_heif.from_pillow(image).save(buffer, quality=80)
+    return buffer.getvalue()
+
+UPLOAD_KINDS = {
+    # kind: (file suffix, content type, builder(size, variant)); size is pages, or pixels for images
+    'pdf': ('.pdf', 'application/pdf', make_pdf),
+    'docx': ('.docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document', make_docx),
+    'heic': ('.heic', 'image/heic', make_heic),
+}
+
+# --- App Server Process ---
+def serve(args):
+    """Runs the app with stub search in the current (throwaway) directory; used by `run`."""
+    sys.path.insert(0, str(REPO_DIR))
+    import app as chat_app
+    chat_app.set_search_backend(StubSearchBackend(args.search_latency))
+    seed_chats(chat_app, args.chats, args.long_messages, random.Random(args.seed))
+    chat_app.sync_chat_index(force=True)
+    chat_app.app.run(host=BENCH_HOST, port=args.port, threaded=True, debug=False, use_reloader=False)
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind((BENCH_HOST, 0))
+        return s.getsockname()[1]
+
+def _wait_until_up(port, path, process, timeout=SERVER_START_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None: return False
+        try:
+            connection = http.client.HTTPConnection(BENCH_HOST, port, timeout=5)
+            connection.request('GET', path)
+            if connection.getresponse().status == 200: return True
+        except OSError:
+            pass
+        time.sleep(0.2)
+    return False
+
+def read_rss_mb(pid):
+    """Current and peak resident memory of a process in MB, from /proc (None where unavailable)."""
+    try:
+        status = Path(f"/proc/{pid}/status").read_text()
+    except OSError:
+        return None, None
+    values = {line.split(':')[0]: int(line.split()[1]) / 1024 for line in status.splitlines() if line.startswith(('VmRSS', 'VmHWM'))}
+    return values.get('VmRSS'), values.get('VmHWM')
+
+class BenchEnvironment:
+    """The stub Ollama and app server processes, started in a throwaway working directory."""
+    def __init__(self, args):
+        self.args = args
+        self.workdir = Path(args.workdir or tempfile.mkdtemp(prefix='chat-bench-'))
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        self.processes = []
+        self.ollama_port = _free_port()
+        self.port = _free_port()
+
+    def _start(self, name, argv, env=None):
+        log = open(self.workdir / f"{name}.log", 'w')
+        process = subprocess.Popen([sys.executable, str(Path(__file__).resolve()), *argv], cwd=self.workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((process, log))
+        return process
+
+    def __enter__(self):
+        args = self.args
+        ollama = self._start('stub-ollama', [
+            'stub-ollama', '--port', str(self.ollama_port), '--tokens-per-second', str(args.tokens_per_second),
+            '--latency', str(args.ollama_latency), '--answer-tokens', str(args.answer_tokens), '--load-latency', str(args.load_latency),
+        ])
+        if not _wait_until_up(self.ollama_port, '/api/tags', ollama): self._fail('stub-ollama')
+        env = {**os.environ, 'OLLAMA_HOST': f"http://{BENCH_HOST}:{self.ollama_port}", 'PYTHONUNBUFFERED': '1'}
+        started = time.monotonic()
+        self.server = self._start('app', [
+            'serve', '--port', str(self.port), '--chats', str(args.chats), '--long-messages', str(args.long_messages),
+            '--search-latency', str(args.search_latency), '--seed', str(args.seed),
+        ], env)
+        if not _wait_until_up(self.port, '/api/chats?limit=1', self.server): self._fail('app')
+        self.startup_seconds = time.monotonic() - started
+        return self
+
+    def _fail(self, name):
+        self.__exit__(None, None, None)
+        log_tail = (self.workdir / f"{name}.log").read_text(errors='replace')[-3000:]
+        raise RuntimeError(f"{name} did not start (log in {self.workdir}):\n{log_tail}")
+
+    def __exit__(self, *exc_info):
+        for process, log in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.close()
+        self.processes = []
+        if not self.args.keep_workdir and not self.args.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def rss_mb(self):
+        return read_rss_mb(self.server.pid)
+
+class RssSampler:
+    """Samples the server's RSS in the background while a scenario runs, keeping the peak."""
+    def __init__(self, pid):
+        self.pid, self.peak = pid, None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            rss, _ = read_rss_mb(self.pid)
+            if rss is not None: self.peak = max(self.peak or 0, rss)
+            if self._stop.wait(RSS_SAMPLE_INTERVAL): return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+# --- HTTP Client ---
+def encode_multipart(fields, files):
+    """Returns (body, content type) for a multipart/form-data request; files are (name, filename, type, bytes)."""
+    boundary = uuid.uuid4().hex
+    body = BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8'))
+    for name, filename, content_type, data in files:
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                   f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8'))
+        body.write(data)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode('utf-8'))
+    return body.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+def http_get(port, path):
+    """Returns (seconds, status, body) of a GET request."""
+    started = time.perf_counter()
+    connection = http.client.HTTPConnection(BENCH_HOST, port, timeout=REQUEST_TIMEOUT)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        body = response.read()
+        return time.perf_counter() - started, response.status, body
+    finally:
+        connection.close()
+
+def stream_turn(port, chat_id, prompt, files=()):
+    """
+    Sends a message over the typed NDJSON stream (with the timings event) and reads the whole
+    answer. Returns a dict with latency, ttft (client-side seconds), chat_id, tokens (as reported
+    by the stub in the usage event), timings (server-side) and error.
+    """
+    path = f"/api/chat/{chat_id}/stream" if chat_id else "/api/chat/stream"
+    body, content_type = encode_multipart({"model": BENCH_MODEL, "prompt": prompt}, files)
+    result = {"chat_id": chat_id, "ttft": None, "tokens": 0, "timings": {}, "error": None}
+    started = time.perf_counter()
+    connection = http.client.HTTPConnection(BENCH_HOST, port, timeout=REQUEST_TIMEOUT)
+    try:
+        connection.request('POST', f"{path}?protocol=ndjson&timings=1", body, {'Content-Type': content_type})
+        response = connection.getresponse()
+        if response.status != 200:
+            result["error"] = f"HTTP {response.status}: {response.read()[:200]!r}"
+            return result
+        for line in response:
+            if not line.strip(): continue
+            event = json.loads(line)
+            kind = event["type"]
+            if kind == 'meta': result["chat_id"] = event.get("chatId", chat_id)
+            elif kind in ('token', 'search') and result["ttft"] is None: result["ttft"] = time.perf_counter() - started
+            elif kind == 'usage': result["tokens"] = event.get("eval_count", 0)
+            elif kind == 'timings': result["timings"] = event
+            elif kind == 'done': break
+    except (OSError, ValueError) as e:
+        result["error"] = str(e)
+    finally:
+        connection.close()
+        result["latency"] = time.perf_counter() - started
+    return result
+
+# --- Statistics ---
+def percentile(values, pct):
+    """Nearest-rank percentile; None for no values."""
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def latency_metrics(prefix, seconds):
+    """p50/p99/mean of a list of durations, in milliseconds."""
+    if not seconds: return {}
+    return {
+        f"{prefix}_p50_ms": round(percentile(seconds, 50) * 1000, 2),
+        f"{prefix}_p99_ms": round(percentile(seconds, 99) * 1000, 2),
+        f"{prefix}_mean_ms": round(sum(seconds) / len(seconds) * 1000, 2),
+    }
+
+def turn_metrics(prefix, turns, wall_seconds=None):
+    """Latency, TTFT, server-side stage timings and throughput of a list of stream_turn results."""
+    ok = [t for t in turns if not t["error"]]
+    metrics = {f"{prefix}_errors": len(turns) - len(ok)}
+    metrics.update(latency_metrics(f"{prefix}_latency", [t["latency"] for t in ok]))
+    metrics.update(latency_metrics(f"{prefix}_ttft", [t["ttft"] for t in ok if t["ttft"] is not None]))
+    for stage in ('queue_wait', 'extraction', 'web_search'):
+        values = [t["timings"][stage] for t in ok if stage in t["timings"]]
+        if values: metrics[f"{prefix}_{stage}_p50_ms"] = round(percentile(values, 50) * 1000, 2)
+    if wall_seconds:
+        metrics[f"{prefix}_requests_per_second"] = round(len(ok) / wall_seconds, 2)
+        metrics[f"{prefix}_tokens_per_second"] = round(sum(t["tokens"] for t in ok) / wall_seconds, 1)
+    return metrics
+
+def run_concurrently(clients, work):
+    """Runs work(client_index) on `clients` threads; returns (list of their results, wall seconds)."""
+    results = [None] * clients
+    def target(index): results[index] = work(index)
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return results, time.perf_counter() - started
+
+# --- Scenarios ---
+# Each scenario takes (environment, args, rng) and returns a flat dict of metrics. Metric names
+# end in _ms, _mb, _per_second or _errors, which tells compare_with_baseline which way is better.
+def scenario_chat_list(env, args, rng):
+    """Sidebar loads over the seeded chats: the full list, one page, and history search."""
+    full, page, search = [], [], []
+    http_get(env.port, '/api/chats') # Warm up
+    for i in range(args.list_requests):
+        full.append(http_get(env.port, '/api/chats')[0])
+        page.append(http_get(env.port, '/api/chats?limit=50')[0])
+        search.append(http_get(env.port, f"/api/search?q={WORDS[i % len(WORDS)]}")[0])
+    return {**latency_metrics('list_full', full), **latency_metrics('list_page', page), **latency_metrics('search', search)}
+
+def scenario_long_chat(env, args, rng):
+    """Opening the long conversation (first page and full) and answering in it."""
+    page = [http_get(env.port, f"/api/chat/{LONG_CHAT_ID}?limit=50")[0] for _ in range(args.list_requests)]
+    full = [http_get(env.port, f"/api/chat/{LONG_CHAT_ID}?full=1")[0] for _ in range(max(1, args.list_requests // 10))]
+    turns = [stream_turn(env.port, LONG_CHAT_ID, _sentence(rng)) for _ in range(args.turns)]
+    return {**latency_metrics('open_page', page), **latency_metrics('open_full', full), **turn_metrics('long_turn', turns)}
+
+def scenario_uploads(env, args, rng):
+    """New chats with one large document or image each; every upload is new, so extraction is cold."""
+    metrics = {}
+    for kind, (suffix, content_type, build) in UPLOAD_KINDS.items():
+        size = args.upload_pages if kind != 'heic' else args.image_side
+        turns = []
+        for repeat in range(args.upload_repeats):
+            try:
+                data = build(size, f"{args.seed}-{repeat}")
+            except Exception as e: # E.g. a libheif build without an HEIC encoder
+                print(f"Skipping {kind} uploads: could not generate a test file ({e})", file=sys.stderr)
+                break
+            metrics[f"{kind}_upload_mb"] = round(len(data) / 1e6, 2)
+            turns.append(stream_turn(env.port, None, f"Summarize this {kind} file.", [("files", f"bench-{repeat}{suffix}", content_type, data)]))
+        if turns: metrics.update(turn_metrics(f"{kind}", turns))
+    return metrics
+
+def scenario_streaming(env, args, rng):
+    """Concurrent clients, each holding a conversation; some turns make the model search the web."""
+    searches = [[rng.random() < args.search_ratio for _ in range(args.turns)] for _ in range(args.clients)]
+    def client(index):
+        chat_id, turns = None, []
+        for turn in range(args.turns):
+            prompt = f"Client {index} turn {turn}: {_sentence(random.Random(f'{args.seed}-{index}-{turn}'))}"
+            if searches[index][turn]: prompt = f"[Web Search Activated] {prompt} {SEARCH_TRIGGER}"
+            result = stream_turn(env.port, chat_id, prompt)
+            chat_id = result["chat_id"] or chat_id
+            turns.append(result)
+        return turns
+    results, wall_seconds = run_concurrently(args.clients, client)
+    return turn_metrics('stream', [turn for turns in results for turn in turns], wall_seconds)
+
+SCENARIO_FUNCTIONS = {
+    'chat_list': scenario_chat_list, 'long_chat': scenario_long_chat,
+    'uploads': scenario_uploads, 'streaming': scenario_streaming,
+}
+
+# --- Reporting and Baselines ---
+def lower_is_better(metric):
+    return not metric.endswith('_per_second')
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Returns report lines and the number of metrics that got worse by more than `tolerance`."""
+    lines, regressions = [], 0
+    changed = [key for key in ('chats', 'long_messages', 'clients', 'turns', 'tokens_per_second', 'answer_tokens')
+               if baseline.get('parameters', {}).get(key) != results['parameters'].get(key)]
+    if changed: lines.append(f"Note: parameters differ from the baseline ({', '.join(changed)}); numbers may not be comparable.")
+    for scenario, metrics in results['scenarios'].items():
+        base_metrics = baseline.get('scenarios', {}).get(scenario)
+        if not base_metrics: continue
+        for metric, value in metrics.items():
+            base = base_metrics.get(metric)
+            if base is None or value is None: continue
+            if metric.endswith('_errors'):
+                worse = value > base
+                change = f"{value - base:+d}"
+            else:
+                ratio = (value - base) / base if base else 0.0
+                worse = (ratio if lower_is_better(metric) else -ratio) > tolerance
+                change = f"{ratio:+.1%}"
+            regressions += worse
+            lines.append(f"  {'REGRESSION ' if worse else ''}{scenario}.{metric}: {base} -> {value} ({change})")
+    return lines, regressions
+
+def format_report(results):
+    lines = [f"Benchmark run {results['started_at']} ({results['platform']})",
+             "Parameters: " + ", ".join(f"{key}={value}" for key, value in results['parameters'].items()),
+             f"App startup (including seeding): {results['startup_seconds']:.2f}s"]
+    for scenario, metrics in results['scenarios'].items():
+        lines.append(f"\n[{scenario}]")
+        lines.extend(f"  {metric:<34} {value}" for metric, value in metrics.items())
+    return lines
+
+def run(args):
+    if args.quick:
+        args.chats, args.long_messages, args.list_requests = min(args.chats, 200), min(args.long_messages, 200), min(args.list_requests, 20)
+        args.clients, args.turns, args.upload_repeats, args.upload_pages = min(args.clients, 4), min(args.turns, 2), 1, min(args.upload_pages, 5)
+    parameters = {key: getattr(args, key) for key in (
+        'chats', 'long_messages', 'list_requests', 'clients', 'turns', 'search_ratio', 'upload_pages', 'image_side',
+        'upload_repeats', 'tokens_per_second', 'ollama_latency', 'answer_tokens', 'load_latency', 'search_latency', 'seed')}
+    results = {
+        "started_at": time.strftime('%Y-%m-%d %H:%M:%S'), "platform": f"{platform.platform()}, Python {platform.python_version()}",
+        "parameters": parameters, "scenarios": {},
+    }
+    with BenchEnvironment(args) as env:
+        results["startup_seconds"] = round(env.startup_seconds, 2)
+        for name in args.scenarios:
+            print(f"Running {name}...", file=sys.stderr)
+            with RssSampler(env.server.pid) as sampler:
+                metrics = SCENARIO_FUNCTIONS[name](env, args, random.Random(f"{args.seed}-{name}"))
+            rss, rss_peak = env.rss_mb()
+            if sampler.peak is not None: metrics["rss_peak_mb"] = round(sampler.peak, 1)
+            if rss is not None: metrics["rss_end_mb"] = round(rss, 1)
+            if rss_peak is not None: metrics["rss_high_water_mb"] = round(rss_peak, 1)
+            results["scenarios"][name] = metrics
+
+    lines = format_report(results)
+    regressions = 0
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        comparison, regressions = compare_with_baseline(results, baseline, args.tolerance)
+        lines += [f"\nCompared with {args.baseline} (tolerance {args.tolerance:.0%}): {regressions} regression(s)"] + comparison
+    report = "\n".join(lines) + "\n"
+    print(report)
+    Path(args.output).write_text(report)
+    if args.json: Path(args.json).write_text(json.dumps(results, indent=2))
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(results, indent=2))
+        print(f"Saved baseline to {args.save_baseline}", file=sys.stderr)
+    return 1 if regressions else 0
+
+def stub_ollama(args):
+    server = StubOllamaServer(args.port, args.tokens_per_second, args.latency, args.answer_tokens, args.load_latency)
+    print(f"Stub Ollama listening on http://{BENCH_HOST}:{args.port}", flush=True)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the chat app against a local stub Ollama and stub web search.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="Run the benchmark scenarios and print a report")
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    run_parser.add_argument('--quick', action='store_true', help="Scale every workload down for a smoke run")
+    run_parser.add_argument('--chats', type=int, default=5000, help="Short chats seeded for the chat list")
+    run_parser.add_argument('--long-messages', type=int, default=2000, help="Messages in the seeded long conversation")
+    run_parser.add_argument('--list-requests', type=int, default=100, help="Requests per endpoint in the read-only scenarios")
+    run_parser.add_argument('--clients', type=int, default=16, help="Concurrent streaming clients")
+    run_parser.add_argument('--turns', type=int, default=4, help="Messages each streaming client (and the long chat) sends")
+    run_parser.add_argument('--search-ratio', type=float, default=0.25, help="Fraction of streaming turns that trigger a web search")
+    run_parser.add_argument('--upload-pages', type=int, default=100, help="Pages of each generated PDF/DOCX upload")
+    run_parser.add_argument('--image-side', type=int, default=3000, help="Side in pixels of each generated HEIC upload")
+    run_parser.add_argument('--upload-repeats', type=int, default=3, help="Uploads per file type")
+    run_parser.add_argument('--tokens-per-second', type=float, default=100, help="Generation speed of the stub Ollama")
+    run_parser.add_argument('--ollama-latency', type=float, default=0.1, help="Seconds the stub Ollama takes before the first token")
+    run_parser.add_argument('--answer-tokens', type=int, default=64, help="Tokens in each stub answer")
+    run_parser.add_argument('--load-latency', type=float, default=1.0, help="Seconds the stub Ollama takes to load a model the first time")
+    run_parser.add_argument('--search-latency', type=float, default=0.3, help="Seconds each stub web search takes")
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--baseline', help="Baseline JSON to compare against (exit status 1 on regressions)")
+    run_parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="Relative change tolerated before a metric counts as a regression")
+    run_parser.add_argument('--save-baseline', help="Write the results as a new baseline JSON")
+    run_parser.add_argument('--json', help="Also write the results as JSON")
+    run_parser.add_argument('--output', default=str(DEFAULT_REPORT_FILE), help="Text report file")
+    run_parser.add_argument('--workdir', help="Working directory for the app (default: a temporary one, deleted afterwards)")
+    run_parser.add_argument('--keep-workdir', action='store_true', help="Keep the temporary working directory and server logs")
+
+    stub_parser = commands.add_parser('stub-ollama', help="Run only the stub Ollama server")
+    stub_parser.add_argument('--port', type=int, default=11434)
+    stub_parser.add_argument('--tokens-per-second', type=float, default=100)
+    stub_parser.add_argument('--latency', type=float, default=0.1)
+    stub_parser.add_argument('--answer-tokens', type=int, default=64)
+    stub_parser.add_argument('--load-latency', type=float, default=1.0)
+
+    serve_parser = commands.add_parser('serve', help="Run the app with stub web search in the current directory (used by run)")
+    serve_parser.add_argument('--port', type=int, required=True)
+    serve_parser.add_argument('--chats', type=int, default=0)
+    serve_parser.add_argument('--long-messages', type=int, default=0)
+    serve_parser.add_argument('--search-latency', type=float, default=0.3)
+    serve_parser.add_argument('--seed', type=int, default=1)
+
+    args = parser.parse_args()
+    if args.command == 'run': sys.exit(run(args))
+    elif args.command == 'stub-ollama': stub_ollama(args)
+    else: serve(args)
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# --- Chat Storage Migration ---
+# Converts existing chats/<id>/history.json folders into the append-only history.jsonl
+# log format used by the 'log' storage backend. Safe to run repeatedly: chats that
+# already have a log are skipped. Run from the same directory as app.py.
+
+import argparse
+
+from app import migrate_chat_storage, sync_chat_index
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate history.json chats to the append-only log format.")
+    parser.add_argument('--delete-legacy', action='store_true', help="Delete history.json instead of keeping history.json.bak")
+    args = parser.parse_args()
+
+    count = migrate_chat_storage(delete_legacy=args.delete_legacy)
+    sync_chat_index(force=True)
+    print(f"Migrated {count} chat(s).")
@@ -23,10 +23,18 @@ document.addEventListener('DOMContentLoaded', () => {
     let currentChatId = null;
     let attachedFiles = [];
     let currentAbortController = null;
+    let currentJob = null; // { chatId, jobId } of the generation being streamed; it keeps running server-side if we disconnect
     let editState = null;
     let availableModels = [];
     let selectedModel = null;
     let isWebSearchEnabled = false;
+    const CHAT_LIST_PAGE_SIZE = 100;
+    const CHAT_SEARCH_DEBOUNCE_MS = 200;
+    const CHAT_MESSAGES_PAGE_SIZE = 50;
+    const LOAD_OLDER_THRESHOLD_PX = 200; // Load the previous page when scrolled this close to the top
+    let oldestLoadedIndex = 0; // Index of the oldest message rendered for the current chat
+    let isLoadingOlder = false;
+    let chatSearchTimer = null;
 
     // --- Icon Definitions ---
     const ICONS = {
@@ -76,11 +84,16 @@ document.addEventListener('DOMContentLoaded', () => {
             }
         });
         stopGeneratingBtn.addEventListener('click', () => {
+            // Aborting the fetch only detaches from the generation, so cancel it explicitly.
+            if (currentJob) fetch(`/api/chat/${currentJob.chatId}/stream/${currentJob.jobId}/cancel`, { method: 'POST' });
             if (currentAbortController) currentAbortController.abort();
         });
         attachFileBtn.addEventListener('click', () => fileInput.click());
         webSearchBtn.addEventListener('click', toggleWebSearch);
         chatWindow.addEventListener('click', handleChatWindowClick);
+        chatWindow.addEventListener('scroll', () => {
+            if (chatWindow.scrollTop < LOAD_OLDER_THRESHOLD_PX) loadOlderMessages();
+        });
     };
 
     // --- UI Rendering and Manipulation ---
@@ -116,17 +129,42 @@ document.addEventListener('DOMContentLoaded', () => {
         mainModelSelectorContainer.appendChild(button);
     };
 
-    const showModelSelectorPopup = (targetElement, onSelectCallback) => {
-        document.querySelectorAll('.model-selector-popup').forEach(p => p.remove());
-        const popup = document.createElement('div');
-        popup.className = 'model-selector-popup';
+    const formatLoadSeconds = (seconds) => `${seconds < 10 ? seconds.toFixed(1) : Math.round(seconds)}s`;
+
+    // One line of model status for the picker: loaded/vision plus median warm and cold load times
+    const modelMetaText = (model) => {
+        const parts = [];
+        if (model.loaded) parts.push('loaded');
+        if ((model.capabilities || []).includes('vision')) parts.push('vision');
+        const loadSeconds = model.loadSeconds || {};
+        if (loadSeconds.warm != null) parts.push(`warm ${formatLoadSeconds(loadSeconds.warm)}`);
+        if (loadSeconds.cold != null) parts.push(`cold ${formatLoadSeconds(loadSeconds.cold)}`);
+        return parts.join(' · ');
+    };
+
+    const renderModelPopupItems = (popup, onSelectCallback) => {
+        popup.innerHTML = '';
         availableModels.forEach(model => {
             const item = document.createElement('div');
             item.className = 'model-popup-item';
-            item.innerHTML = `<div class="model-avatar">${generateModelAvatar(model.name)}</div><span class="model-name">${model.name}</span>`;
+            const meta = modelMetaText(model);
+            item.innerHTML = `<div class="model-avatar">${generateModelAvatar(model.name)}</div><div class="model-popup-text"><span class="model-name">${model.name}</span>${meta ? `<span class="model-meta">${meta}</span>` : ''}</div>`;
             item.onclick = () => { onSelectCallback(model.name); popup.remove(); };
             popup.appendChild(item);
         });
+    };
+
+    const showModelSelectorPopup = (targetElement, onSelectCallback) => {
+        document.querySelectorAll('.model-selector-popup').forEach(p => p.remove());
+        const popup = document.createElement('div');
+        popup.className = 'model-selector-popup';
+        renderModelPopupItems(popup, onSelectCallback);
+        // Load state and load times change while the app is used; refresh them in the background
+        fetch('/api/models').then(response => response.ok ? response.json() : null).then(models => {
+            if (!models || models.length === 0) return;
+            availableModels = models;
+            if (popup.isConnected) renderModelPopupItems(popup, onSelectCallback);
+        }).catch(error => console.error('Error refreshing models:', error));
         document.body.appendChild(popup);
         const rect = targetElement.getBoundingClientRect();
         popup.style.left = `${rect.left}px`;
@@ -159,7 +197,11 @@ document.addEventListener('DOMContentLoaded', () => {
         messageHeader.className = 'message-header';
         messageHeader.innerHTML = `<span class="sender-name">${role === 'user' ? 'You' : 'Assistant'}</span>`;
         if (role === 'assistant' && model) {
-            messageHeader.innerHTML += `<span class="model-tag">${model}</span>`;
+            // The model name comes from the stream's meta event (i.e. the request), so set it as text
+            const modelTag = document.createElement('span');
+            modelTag.className = 'model-tag';
+            modelTag.textContent = model;
+            messageHeader.append(modelTag);
         }
 
         const messageContent = document.createElement('div');
@@ -214,14 +256,15 @@ document.addEventListener('DOMContentLoaded', () => {
                 regenerateBtn.className = 'action-btn';
                 regenerateBtn.title = 'Regenerate';
                 regenerateBtn.innerHTML = ICONS.regenerate;
-                regenerateBtn.onclick = () => handleRegenerateMessage(currentChatId, index, model);
+                // Indices shift when earlier messages are deleted, so read the current one on click
+                regenerateBtn.onclick = () => handleRegenerateMessage(currentChatId, parseInt(container.dataset.msgIndex), model);
                 const optionsBtn = document.createElement('button');
                 optionsBtn.className = 'action-btn';
                 optionsBtn.title = 'Regenerate with another model';
                 optionsBtn.innerHTML = `<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 512 512" width="1em" height="1em"><path fill="currentColor" d="M233.4 406.6c12.5 12.5 32.8 12.5 45.3 0l192-192c12.5-12.5 12.5-32.8 0-45.3s-32.8-12.5-45.3 0L256 338.7 86.6 169.4c-12.5-12.5-32.8-12.5-45.3 0s-12.5 32.8 0 45.3l192 192z"/></svg>`;
                 optionsBtn.onclick = (e) => {
                     e.stopPropagation();
-                    showModelSelectorPopup(e.currentTarget, newModel => handleRegenerateMessage(currentChatId, index, newModel));
+                    showModelSelectorPopup(e.currentTarget, newModel => handleRegenerateMessage(currentChatId, parseInt(container.dataset.msgIndex), newModel));
                 };
                 regenerateGroup.appendChild(regenerateBtn);
                 regenerateGroup.appendChild(optionsBtn);
@@ -231,14 +274,14 @@ document.addEventListener('DOMContentLoaded', () => {
                 editBtn.className = 'action-btn';
                 editBtn.title = 'Edit and Regenerate';
                 editBtn.innerHTML = ICONS.edit;
-                editBtn.onclick = () => handleEditMessage(currentChatId, index);
+                editBtn.onclick = () => handleEditMessage(currentChatId, parseInt(container.dataset.msgIndex));
                 messageActions.appendChild(editBtn);
             }
             const deleteBtn = document.createElement('button');
             deleteBtn.className = 'action-btn';
             deleteBtn.title = 'Delete';
             deleteBtn.innerHTML = ICONS.delete;
-            deleteBtn.onclick = () => handleDeleteMessage(currentChatId, index);
+            deleteBtn.onclick = () => handleDeleteMessage(currentChatId, parseInt(container.dataset.msgIndex));
             messageActions.appendChild(deleteBtn);
             messageBubble.appendChild(messageActions);
         }
@@ -310,14 +353,38 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     };
     
-    const filterChatList = () => {
-        const query = searchThreadsInput.value.toLowerCase();
+    const applyChatListFilter = (query, snippets) => {
         document.querySelectorAll('.chat-list-item').forEach(item => {
             const title = item.querySelector('.chat-title').textContent.toLowerCase();
-            item.style.display = title.includes(query) ? 'flex' : 'none';
+            const snippet = snippets.get(item.dataset.chatId);
+            item.style.display = title.includes(query) || snippet ? 'flex' : 'none';
+            const snippetText = document.createElement('div');
+            snippetText.innerHTML = snippet || ''; // Escaped by the server, matches wrapped in <mark>
+            item.title = snippetText.textContent;
         });
     };
 
+    const filterChatList = () => {
+        // Title matches are shown immediately; matches inside messages and documents come from /api/search.
+        const query = searchThreadsInput.value.trim().toLowerCase();
+        applyChatListFilter(query, new Map());
+        clearTimeout(chatSearchTimer);
+        if (!query) return;
+        chatSearchTimer = setTimeout(async () => {
+            try {
+                const response = await fetch(`/api/search?q=${encodeURIComponent(query)}&limit=100`);
+                if (!response.ok) throw new Error((await response.json()).error || 'Search failed');
+                const hits = await response.json();
+                if (searchThreadsInput.value.trim().toLowerCase() !== query) return; // A newer search is pending
+                const snippets = new Map();
+                hits.forEach(hit => { if (!snippets.has(hit.chatId)) snippets.set(hit.chatId, hit.snippet); });
+                applyChatListFilter(query, snippets);
+            } catch (error) {
+                console.error('Error searching chats:', error);
+            }
+        }, CHAT_SEARCH_DEBOUNCE_MS);
+    };
+
     // --- Core Logic and API Communication ---
     const loadModels = async () => {
         try {
@@ -342,10 +409,19 @@ document.addEventListener('DOMContentLoaded', () => {
 
     const loadChatList = async () => {
         try {
-            const chats = await (await fetch('/api/chats')).json();
+            // Fetch the list page by page so the newest chats render before the rest arrive
             chatList.innerHTML = '';
-            chats.forEach(chat => addChatToList(chat.id, chat.title));
-            updateActiveChatItem(currentChatId);
+            let cursor = null;
+            do {
+                const params = new URLSearchParams({ limit: CHAT_LIST_PAGE_SIZE });
+                if (cursor) params.set('cursor', cursor);
+                const response = await fetch(`/api/chats?${params}`);
+                const chats = await response.json();
+                chats.forEach(chat => addChatToList(chat.id, chat.title));
+                updateActiveChatItem(currentChatId);
+                filterChatList();
+                cursor = response.headers.get('X-Next-Cursor');
+            } while (cursor);
         } catch (error) {
             console.error('Error loading chat list:', error);
         }
@@ -355,14 +431,17 @@ document.addEventListener('DOMContentLoaded', () => {
         if (currentAbortController) currentAbortController.abort();
         if (currentChatId === chatId && !chatWindow.querySelector('.welcome-screen')) return;
         try {
-            const response = await fetch(`/api/chat/${chatId}`);
+            const response = await fetch(`/api/chat/${chatId}?limit=${CHAT_MESSAGES_PAGE_SIZE}`);
             if (!response.ok) throw new Error('Chat not found');
             const chat = await response.json();
             currentChatId = chatId;
+            oldestLoadedIndex = chat.firstIndex;
             chatWindow.innerHTML = '';
-            chat.messages.forEach((msg, index) => renderMessage(msg, index));
+            chat.messages.forEach((msg, i) => renderMessage(msg, chat.firstIndex + i));
             updateActiveChatItem(chatId);
             chatWindow.scrollTop = chatWindow.scrollHeight;
+            if (chat.activeJobId) resumeGeneration(chatId, chat.activeJobId, chat.messageCount);
+            if (chatWindow.scrollHeight <= chatWindow.clientHeight) loadOlderMessages(); // Nothing to scroll yet
         } catch (error) {
             console.error('Error loading chat:', error);
             createNewChat(); // Reset to a clean state
@@ -370,6 +449,31 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     };
 
+    const loadOlderMessages = async () => {
+        if (isLoadingOlder || oldestLoadedIndex <= 0 || !currentChatId) return;
+        isLoadingOlder = true;
+        const chatId = currentChatId;
+        try {
+            const response = await fetch(`/api/chat/${chatId}?before=${oldestLoadedIndex}&limit=${CHAT_MESSAGES_PAGE_SIZE}`);
+            if (!response.ok) throw new Error('Failed to load older messages');
+            const chat = await response.json();
+            if (chatId !== currentChatId) return; // Switched chats meanwhile
+
+            // Insert above the rendered messages, keeping the visible part of the chat in place
+            const previousHeight = chatWindow.scrollHeight;
+            const anchor = chatWindow.firstChild;
+            chat.messages.forEach((msg, i) => chatWindow.insertBefore(renderMessage(msg, chat.firstIndex + i), anchor));
+            chatWindow.scrollTop += chatWindow.scrollHeight - previousHeight;
+            oldestLoadedIndex = chat.firstIndex;
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+            return;
+        } finally {
+            isLoadingOlder = false;
+        }
+        if (chatWindow.scrollHeight <= chatWindow.clientHeight) loadOlderMessages();
+    };
+
     const handleFormSubmit = async (e) => {
         e.preventDefault();
         if (editState) {
@@ -391,7 +495,7 @@ document.addEventListener('DOMContentLoaded', () => {
         formData.append('prompt', prompt);
         attachedFiles.forEach(file => formData.append('files', file));
         
-        const endpoint = currentChatId ? `/api/chat/${currentChatId}/stream` : '/api/chat/stream';
+        const endpoint = (currentChatId ? `/api/chat/${currentChatId}/stream` : '/api/chat/stream') + '?protocol=ndjson';
         if (chatWindow.querySelector('.welcome-screen')) chatWindow.innerHTML = '';
 
         clearFileInputs();
@@ -410,60 +514,120 @@ document.addEventListener('DOMContentLoaded', () => {
             sendBtn.classList.remove('hidden');
             stopGeneratingBtn.classList.add('hidden');
             currentAbortController = null;
+            currentJob = null;
         }
     };
 
-    const processStream = async (response, isNewChat) => {
+    const resumeGeneration = async (chatId, jobId, msgIndex) => {
+        // Reattaches to a generation that is still running on the server (e.g. after a page reload).
+        currentAbortController = new AbortController();
+        sendBtn.classList.add('hidden');
+        stopGeneratingBtn.classList.remove('hidden');
+        currentJob = { chatId, jobId };
+
+        let aiMessageContainer = null;
+        let buffer = '';
+        try {
+            const response = await fetch(`/api/chat/${chatId}/stream/${jobId}?offset=0&protocol=ndjson`, { signal: currentAbortController.signal });
+            if (!response.ok) return; // Finished or no longer buffered; the saved history is already shown
+            aiMessageContainer = renderMessage({ role: 'assistant', content: '', model: selectedModel }, msgIndex, true);
+            const contentDiv = aiMessageContainer.querySelector('.message-content');
+            await readStreamEvents(response, event => {
+                if (!isAnswerEvent(event)) return;
+                buffer += event.text;
+                contentDiv.innerHTML = marked.parse(buffer + '<span class="loading-pulse"></span>');
+                chatWindow.scrollTop = chatWindow.scrollHeight;
+            });
+        } catch (error) {
+            if (error.name !== 'AbortError') console.error("Error resuming generation:", error);
+        } finally {
+            if (aiMessageContainer && currentChatId === chatId) {
+                const finalContent = buffer + (currentAbortController?.signal.aborted ? "\n\n*(Generation stopped by user)*" : "");
+                renderMessage({ role: 'assistant', content: finalContent, model: selectedModel }, msgIndex);
+            }
+            sendBtn.classList.remove('hidden');
+            stopGeneratingBtn.classList.add('hidden');
+            currentAbortController = null;
+            currentJob = null;
+        }
+    };
+
+    const renderStreamStatus = (contentDiv, message) => {
+        // Status text can contain file names and error messages, so it is set as text, never as HTML
+        const statusLine = document.createElement('p');
+        statusLine.className = 'stream-status';
+        const statusText = document.createElement('em');
+        statusText.textContent = message;
+        const pulse = document.createElement('span');
+        pulse.className = 'loading-pulse';
+        statusLine.append(statusText, ' ', pulse);
+        contentDiv.replaceChildren(statusLine);
+    };
+
+    const isAnswerEvent = (event) => event.type === 'token' || event.type === 'search' || event.type === 'sources';
+
+    const readStreamEvents = async (response, onEvent) => {
+        // Reads a typed NDJSON stream (?protocol=ndjson): one JSON event per line.
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
+        let pending = '';
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            pending += decoder.decode(value, { stream: true });
+            const lines = pending.split('\n');
+            pending = lines.pop();
+            for (const line of lines) {
+                if (!line) continue;
+                let event;
+                try { event = JSON.parse(line); } catch (e) { console.error("Failed to parse stream event:", e); continue; }
+                onEvent(event);
+            }
+        }
+    };
+
+    const processStream = async (response, isNewChat) => {
+        // Event order: meta (chat/job ids, the new user message), status events (document
+        // extraction, queue position), answer events (token, search, sources), usage, done.
         let buffer = '';
-        const separator = '\n---\n';
-        let initialDataHandled = false;
         let aiMessageContainer, contentDiv;
+        let model = selectedModel;
 
         try {
-            while (true) {
-                const { value, done } = await reader.read();
-                if (done) break;
-                buffer += decoder.decode(value, { stream: true });
-
-                if (!initialDataHandled && buffer.includes(separator)) {
-                    const parts = buffer.split(separator, 2);
-                    const initialJson = parts[0];
-                    buffer = parts[1] || '';
-                    try {
-                        const data = JSON.parse(initialJson);
-                        renderMessage(data.user_message, document.querySelectorAll('.message-container').length);
-                        if (isNewChat) {
-                            currentChatId = data.chatId;
-                            addChatToList(data.chatId, "New Chat", true);
-                            updateActiveChatItem(currentChatId);
-                            fetch(`/api/chat/${data.chatId}/generate_title`, { method: 'POST' })
-                                .then(res => res.json())
-                                .then(titleData => {
-                                    if (titleData.newTitle) {
-                                        const el = document.querySelector(`.chat-list-item[data-chat-id="${titleData.chatId}"] .chat-title`);
-                                        if (el) el.textContent = titleData.newTitle;
-                                    }
-                                });
-                        }
-                        aiMessageContainer = renderMessage({ role: 'assistant', content: '', model: selectedModel }, document.querySelectorAll('.message-container').length, true);
-                        contentDiv = aiMessageContainer.querySelector('.message-content');
-                        initialDataHandled = true;
-                    } catch (e) { console.error("Failed to parse initial data:", e); }
-                }
-
-                if (initialDataHandled) {
+            await readStreamEvents(response, event => {
+                if (event.type === 'meta') {
+                    currentJob = { chatId: event.chatId, jobId: event.jobId };
+                    if (event.model) model = event.model;
+                    if (event.user_message) renderMessage(event.user_message, event.userMessageIndex ?? document.querySelectorAll('.message-container').length);
+                    if (isNewChat) {
+                        currentChatId = event.chatId;
+                        addChatToList(event.chatId, "New Chat", true);
+                        updateActiveChatItem(currentChatId);
+                        fetch(`/api/chat/${event.chatId}/generate_title`, { method: 'POST' })
+                            .then(res => res.json())
+                            .then(titleData => {
+                                if (titleData.newTitle) {
+                                    const el = document.querySelector(`.chat-list-item[data-chat-id="${titleData.chatId}"] .chat-title`);
+                                    if (el) el.textContent = titleData.newTitle;
+                                }
+                            });
+                    }
+                    aiMessageContainer = renderMessage({ role: 'assistant', content: '', model: model }, event.messageIndex ?? document.querySelectorAll('.message-container').length, true);
+                    contentDiv = aiMessageContainer.querySelector('.message-content');
+                } else if (event.type === 'status' && contentDiv && !buffer) {
+                    renderStreamStatus(contentDiv, event.message);
+                } else if (isAnswerEvent(event) && contentDiv) {
+                    buffer += event.text;
                     contentDiv.innerHTML = marked.parse(buffer + '<span class="loading-pulse"></span>');
                     chatWindow.scrollTop = chatWindow.scrollHeight;
                 }
-            }
+            });
         } catch (error) {
             if (error.name !== 'AbortError') console.error("Stream reading error:", error);
         } finally {
             if (aiMessageContainer) {
                 const finalContent = buffer + (currentAbortController?.signal.aborted ? "\n\n*(Generation stopped by user)*" : "");
-                renderMessage({ role: 'assistant', content: finalContent, model: selectedModel }, parseInt(aiMessageContainer.dataset.msgIndex));
+                renderMessage({ role: 'assistant', content: finalContent, model: model }, parseInt(aiMessageContainer.dataset.msgIndex));
                 chatWindow.scrollTop = chatWindow.scrollHeight;
             }
         }
@@ -495,7 +659,7 @@ document.addEventListener('DOMContentLoaded', () => {
         
         document.querySelectorAll(`.message-container[data-msg-index="${msgIndex}"]`).forEach(el => el.remove());
         
-        const endpoint = `/api/chat/${chatId}/regenerate`;
+        const endpoint = `/api/chat/${chatId}/regenerate?protocol=ndjson`;
         const model = modelToUse || selectedModel;
         const payload = { model: model, msg_index: msgIndex };
         const aiMessageContainer = renderMessage({ role: 'assistant', content: '', model: model }, msgIndex, true);
@@ -505,17 +669,14 @@ document.addEventListener('DOMContentLoaded', () => {
         try {
             const response = await fetch(endpoint, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload), signal: currentAbortController.signal });
             if (!response.ok) throw new Error(await response.text());
+            currentJob = { chatId, jobId: response.headers.get('X-Job-Id') };
             
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder();
-
-            while(true) {
-                const { value, done } = await reader.read();
-                if (done) break;
-                buffer += decoder.decode(value, { stream: true });
+            await readStreamEvents(response, event => {
+                if (!isAnswerEvent(event)) return;
+                buffer += event.text;
                 contentDiv.innerHTML = marked.parse(buffer + '<span class="loading-pulse"></span>');
                 chatWindow.scrollTop = chatWindow.scrollHeight;
-            }
+            });
         } catch (error) {
             if (error.name !== 'AbortError') buffer = `**Error regenerating response:** ${error.message}`;
         } finally {
@@ -524,6 +685,7 @@ document.addEventListener('DOMContentLoaded', () => {
             sendBtn.classList.remove('hidden');
             stopGeneratingBtn.classList.add('hidden');
             currentAbortController = null;
+            currentJob = null;
         }
     };
     
@@ -569,10 +731,11 @@ document.addEventListener('DOMContentLoaded', () => {
         sendBtn.title = "Send";
         
         try {
-            const endpoint = `/api/chat/${editState.chatId}/edit_and_regenerate`;
+            const endpoint = `/api/chat/${editState.chatId}/edit_and_regenerate?protocol=ndjson`;
             const payload = { new_prompt: newPrompt, msg_index: editState.msgIndex, model: selectedModel };
             const response = await fetch(endpoint, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload), signal: currentAbortController.signal });
             if (!response.ok) throw new Error(await response.text());
+            currentJob = { chatId: editState.chatId, jobId: response.headers.get('X-Job-Id') };
             
             await processStream(response, false);
 
@@ -586,6 +749,7 @@ document.addEventListener('DOMContentLoaded', () => {
             stopGeneratingBtn.classList.add('hidden');
             sendBtn.classList.remove('hidden');
             currentAbortController = null;
+            currentJob = null;
         }
     };
     
@@ -596,9 +760,14 @@ document.addEventListener('DOMContentLoaded', () => {
             const data = await response.json();
             if (!response.ok) throw new Error(data.error || 'Failed to delete message.');
             
-            chatWindow.innerHTML = '';
-            data.remaining_messages.forEach((msg, index) => renderMessage(msg, index));
-            if (data.remaining_messages.length === 0) renderWelcomeScreen();
+            // Apply the diff: drop the deleted messages and move later ones up
+            const { index, count } = data.deleted;
+            document.querySelectorAll('.message-container[data-msg-index]').forEach(el => {
+                const elIndex = parseInt(el.dataset.msgIndex);
+                if (elIndex >= index + count) el.dataset.msgIndex = elIndex - count;
+                else if (elIndex >= index) el.remove();
+            });
+            if (data.messageCount === 0) renderWelcomeScreen();
 
         } catch (error) {
             console.error(error);
@@ -609,6 +778,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const createNewChat = () => {
         if (currentAbortController) currentAbortController.abort();
         currentChatId = null;
+        oldestLoadedIndex = 0;
         editState = null;
         isWebSearchEnabled = false;
         webSearchBtn.classList.remove('active');